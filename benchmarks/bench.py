@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import logging
+import pathlib
+import argparse
+import platform
+import tempfile
+import functools
+import statistics
+import subprocess
+import http.client
+import concurrent.futures
+
+import bottle
+import ffmpeg
+import PIL
+import PIL.Image
+
+PATH_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PATH_ROOT))
+
+import mediasurf  # noqa: E402
+
+
+class Defaults:
+    IMAGES = 200
+    VIDEOS = 10
+    SEED = 0
+    REPEAT = 20
+
+    HTTP_CONCURRENCY = 8
+    HTTP_REQUESTS = 400
+
+    USER_INTERFACE = "bootstrap5"
+
+    QUERIES = [
+        "",
+        "sort:name",
+        "sort:date order:asc",
+        "sort:tag:DateTime:d",
+        "sort:tag:ISOSpeedRatings:n order:asc",
+        "name:img_0001",
+        "tag:Make:Canon",
+        "tag:Model",
+        "type:image sort:name order:asc",
+        "date:2021",
+        "from:2010/12/31 to:2030",
+        "from:2000/01 type:video",
+    ]
+
+    EXIF_MAKES = ["Canon", "Nikon", "Sony", "Fujifilm"]
+
+
+def summarise(durations):
+    durations = sorted(durations)
+
+    def percentile(p):
+        return durations[min(len(durations) - 1, int(round(p / 100 * (len(durations) - 1))))]
+
+    return {
+        "count": len(durations),
+        "min": durations[0],
+        "max": durations[-1],
+        "mean": statistics.mean(durations),
+        "median": statistics.median(durations),
+        "p95": percentile(95),
+        "p99": percentile(99),
+    }
+
+
+def timed(f, *args, **kwargs):
+    time_start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return time.perf_counter() - time_start, result
+
+
+def new_request(query):
+    return bottle.BaseRequest({
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": "/",
+        "QUERY_STRING": bottle.urlencode({"search": query}) if query else "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8080",
+        "HTTP_HOST": "localhost:8080",
+        "wsgi.url_scheme": "http",
+    })
+
+
+def generate_corpus(path_corpus, count_images, count_videos, seed):
+    logging.info("generating corpus: %d images, %d videos in %s", count_images, count_videos, path_corpus)
+
+    rng = random.Random(seed)
+
+    # NOTE: the media are spread over a few directories to exercise the recursive scan
+    paths_directory = [path_corpus / ("album_%02d" % i) for i in range(max(1, count_images // 50))]
+    for path in paths_directory:
+        path.mkdir(parents=True, exist_ok=True)
+
+    formats = [("jpg", "JPEG"), ("png", "PNG"), ("gif", "GIF")]
+    for i in range(count_images):
+        extension, format = formats[i % len(formats)]
+        width = rng.choice([640, 1280, 1920, 3000, 4000])
+        height = rng.choice([480, 720, 1080, 2000, 3000])
+
+        im = PIL.Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+        # NOTE: a gradient makes the encoders do some actual work
+        im.paste(PIL.Image.linear_gradient("L").resize((width // 2, height // 2)).convert("RGB"), (width // 4, height // 4))
+
+        exif = PIL.Image.Exif()
+        exif[0x010F] = rng.choice(Defaults.EXIF_MAKES)  # Make
+        exif[0x0110] = "Model %d" % rng.randrange(10)  # Model
+        exif[0x0132] = "%04d:%02d:%02d %02d:%02d:%02d" % (rng.randint(2005, 2025), rng.randint(1, 12), rng.randint(1, 28),
+                                                           rng.randrange(24), rng.randrange(60), rng.randrange(60))  # DateTime
+        exif[0x8827] = rng.choice([100, 200, 400, 800, 1600])  # ISOSpeedRatings
+
+        path_image = paths_directory[i % len(paths_directory)] / ("img_%05d.%s" % (i, extension))
+        if format == "GIF":
+            # NOTE: the GIF format cannot carry EXIF data
+            im.convert("P").save(path_image, format=format)
+        else:
+            im.save(path_image, format=format, exif=exif)
+
+    if count_videos and shutil.which("ffmpeg") is None:
+        logging.warning("ffmpeg not found, no video will be generated")
+        count_videos = 0
+
+    for i in range(count_videos):
+        path_video = paths_directory[i % len(paths_directory)] / ("vid_%05d.mp4" % i)
+        size = rng.choice(["320x240", "640x360", "1280x720"])
+
+        try:
+            ffmpeg.input("testsrc=size=%s:rate=25" % size, f="lavfi", t=1) \
+                  .output(str(path_video), vcodec="libx264", pix_fmt="yuv420p",
+                          metadata="title=Video %d" % i) \
+                  .overwrite_output() \
+                  .run(capture_stdout=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            logging.error("unable to generate video: %s", e.stderr)
+
+    return {
+        "images": count_images,
+        "videos": count_videos,
+        "bytes": sum(p.stat().st_size for p in path_corpus.rglob("*") if p.is_file()),
+    }
+
+
+def bench_database(path_corpus, path_thumbnails, repeat):
+    durations = []
+    mdb = None
+    for _ in range(repeat):
+        duration, mdb = timed(mediasurf.MediaDatabase, [path_corpus], mediasurf.ThumbnailStore(path_thumbnails))
+        durations.append(duration)
+
+    return mdb, {
+        "media": len(mdb.db),
+        "seconds": summarise(durations),
+    }
+
+
+def bench_queries(mdb, queries, repeat):
+    results = {}
+    for query in queries:
+        all_entries = list(mdb.db.values())
+
+        duration_cold, page = timed(mediasurf.Page, all_entries, new_request(query))
+        durations_warm = [timed(mediasurf.Page, all_entries, new_request(query))[0] for _ in range(repeat)]
+
+        results[query] = {
+            "matches": page.all_entries_count,
+            "cold": duration_cold,
+            "warm": summarise(durations_warm),
+        }
+
+    return results
+
+
+def bench_thumbnails(mdb, path_thumbnails, repeat):
+    results = {}
+    for type in ["image", "video"]:
+        medias = [m for m in mdb.db.values() if m.type == type][:repeat]
+        if not medias:
+            continue
+
+        results[type] = {}
+        for breakpoint in ["sm", "md", "lg", "xl", "xxl"]:
+            durations = []
+            for media in medias:
+                path_thumbnail = path_thumbnails / media.ThumbnailName(breakpoint)
+                duration, success = timed(media.CreateThumbnail, breakpoint, path_thumbnail)
+                if success:
+                    durations.append(duration)
+
+            if durations:
+                results[type][breakpoint] = summarise(durations)
+
+    return results
+
+
+def bench_render(mdb, path_ui, repeat):
+    bottle.TEMPLATE_PATH = [path_ui / "templates"]
+
+    router = mediasurf.router_t(
+        get_url=bottle.app().get_url,
+        current_route_name="index",
+        current_url="/",
+    )
+
+    results = {}
+    for limit in [25, 100]:
+        request = new_request("")
+        request.environ["QUERY_STRING"] = "limit=%d" % limit
+        page = mediasurf.Page(list(mdb.db.values()), request)
+
+        # NOTE: fragments are rendered every time without a cache, as they were before it was introduced
+        def render(fragments):
+            return bottle.mako_template("index", router=router, page=page,
+                                        fragment=functools.partial(fragments.Get, mdb.generation),
+                                        static_export=False, video_previews=False)
+
+        durations = [timed(render, mediasurf.FragmentCache())[0] for _ in range(repeat)]
+        results["limit_%d" % limit] = summarise(durations)
+
+        durations = [timed(render, mdb.fragments)[0] for _ in range(repeat)]
+        results["limit_%d_cached" % limit] = summarise(durations)
+
+    return results
+
+
+def wait_for_port(host, port, timeout):
+    time_limit = time.monotonic() + timeout
+    while time.monotonic() < time_limit:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def bench_http(path_corpus, path_ephemerals, path_data, queries, concurrency, count_requests):
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        port = s.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, str(PATH_ROOT / "mediasurf.py"),
+                               "-D", str(path_data), "-E", str(path_ephemerals),
+                               "-P", str(port), "--preview-jobs", "0", str(path_corpus)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        if not wait_for_port("localhost", port, 120):
+            logging.error("the server didn't start listening")
+            return None
+
+        urls = ["/?%s" % bottle.urlencode({"search": query}) if query else "/" for query in queries]
+
+        def fetch(url):
+            connection = http.client.HTTPConnection("localhost", port, timeout=60)
+            try:
+                time_start = time.perf_counter()
+                connection.request("GET", url)
+                r = connection.getresponse()
+                r.read()
+                return time.perf_counter() - time_start, r.status
+            finally:
+                connection.close()
+
+        time_start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            responses = list(executor.map(fetch, (urls[i % len(urls)] for i in range(count_requests))))
+        duration = time.perf_counter() - time_start
+
+        return {
+            "concurrency": concurrency,
+            "requests": count_requests,
+            "errors": sum(1 for _, status in responses if status != 200),
+            "seconds": duration,
+            "requests_per_second": count_requests / duration,
+            "latency": summarise([d for d, _ in responses]),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", str(PATH_ROOT), "describe", "--always", "--dirty"],
+                              capture_output=True, check=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class CliOptions(argparse.Namespace):
+    def __init__(self, args):
+        parser = argparse.ArgumentParser(description="MediaSurf benchmark suite")
+        parser.add_argument("-d", "--debug", action="store_true", help="Display debug messages")
+        parser.add_argument("-v", "--verbose", action="store_true", help="Display informational messages")
+        parser.add_argument("-i", "--images", type=int, default=Defaults.IMAGES, help="Amount of images in the generated corpus")
+        parser.add_argument("-V", "--videos", type=int, default=Defaults.VIDEOS, help="Amount of videos in the generated corpus")
+        parser.add_argument("-s", "--seed", type=int, default=Defaults.SEED, help="Seed of the corpus generator")
+        parser.add_argument("-r", "--repeat", type=int, default=Defaults.REPEAT, help="Amount of times each measurement is repeated")
+        parser.add_argument("-c", "--concurrency", type=int, default=Defaults.HTTP_CONCURRENCY, help="Amount of concurrent HTTP clients")
+        parser.add_argument("-n", "--requests", type=int, default=Defaults.HTTP_REQUESTS, help="Amount of HTTP requests to send")
+        parser.add_argument("-C", "--corpus", help="Path to the directory the corpus is generated in (a temporary one is used by default)")
+        parser.add_argument("-U", "--user-interface", default=Defaults.USER_INTERFACE, help="Name of the user interface to render")
+        parser.add_argument("-o", "--output", help="Path to the file the results are written to (standard output by default)")
+        parser.add_argument("--skip-http", action="store_true", help="Don't run the HTTP load benchmark")
+
+        parser.parse_args(args, self)
+
+
+def main(av):
+    cli_options = CliOptions(av[1:])
+
+    logging_level = logging.WARN
+    if cli_options.debug:
+        logging_level = logging.DEBUG
+    elif cli_options.verbose:
+        logging_level = logging.INFO
+    logging.basicConfig(level=logging_level,
+                        format="[%(asctime)s][%(levelname)s]: %(message)s")
+
+    path_data = PATH_ROOT / "runtime"
+    path_ui = path_data / "ui" / cli_options.user_interface
+
+    with tempfile.TemporaryDirectory(prefix="mediasurf-bench-") as path_tmp:
+        path_tmp = pathlib.Path(path_tmp)
+
+        path_corpus = pathlib.Path(cli_options.corpus) if cli_options.corpus else path_tmp / "corpus"
+        path_ephemerals = path_tmp / "ephemerals"
+        path_thumbnails = path_ephemerals / "thumbnails"
+        path_thumbnails.mkdir(parents=True)
+
+        # NOTE: an existing corpus is re-used as-is, to compare runs over the exact same files
+        if path_corpus.is_dir() and any(path_corpus.iterdir()):
+            corpus = {
+                "bytes": sum(p.stat().st_size for p in path_corpus.rglob("*") if p.is_file()),
+            }
+        else:
+            path_corpus.mkdir(parents=True, exist_ok=True)
+            corpus = generate_corpus(path_corpus, cli_options.images, cli_options.videos, cli_options.seed)
+
+        results = {}
+
+        logging.info("benchmarking the media database")
+        mdb, results["database"] = bench_database(path_corpus, path_thumbnails, max(1, cli_options.repeat // 10))
+        corpus["media"] = len(mdb.db)
+
+        logging.info("benchmarking the queries")
+        results["queries"] = bench_queries(mdb, Defaults.QUERIES, cli_options.repeat)
+
+        logging.info("benchmarking the thumbnails")
+        results["thumbnails"] = bench_thumbnails(mdb, path_thumbnails, cli_options.repeat)
+
+        logging.info("benchmarking the rendering")
+        results["render"] = bench_render(mdb, path_ui, cli_options.repeat)
+
+        if not cli_options.skip_http:
+            logging.info("benchmarking the HTTP server")
+            results["http"] = bench_http(path_corpus, path_ephemerals, path_data, Defaults.QUERIES,
+                                         cli_options.concurrency, cli_options.requests)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "versions": {
+                "bottle": bottle.__version__,
+                "pillow": PIL.__version__,
+            },
+            "parameters": {
+                "seed": cli_options.seed,
+                "repeat": cli_options.repeat,
+            },
+            "corpus": corpus,
+        },
+        "results": results,
+    }
+
+    if cli_options.output:
+        with open(cli_options.output, "w") as fout:
+            json.dump(report, fout, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
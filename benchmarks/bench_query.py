@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import time
+import logging
+import pathlib
+import argparse
+import statistics
+
+PATH_ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PATH_ROOT))
+
+import mediasurf  # noqa: E402
+
+
+class Defaults:
+    PATH_CORPUS = pathlib.Path(__file__).resolve().parent / "queries.json"
+    REPEAT = 200
+
+
+def clear_caches():
+    mediasurf.Date._match_datetime.cache_clear()
+    mediasurf.QueryParser._parse.cache_clear()
+    mediasurf.QueryParser.ParseDate.cache_clear()
+
+
+def parse_query(query):
+    try:
+        q = mediasurf.QueryParser(query)
+    except mediasurf.QueryError:
+        return None
+
+    return [[k, v if isinstance(v, str) else v.asList()] for k, v in q.items()]
+
+
+def parse_date(s):
+    try:
+        d = mediasurf.QueryParser.ParseDate(s)
+    except ValueError:
+        return {"error": "ValueError"}
+
+    if d is None:
+        return None
+
+    return {
+        "date": d.isoformat(),
+        "hints": [h.name for h in mediasurf.DateHints if h in d.hints],
+    }
+
+
+# NOTE: every entry is checked twice, to make sure that the caches return the same results as the parser
+def check_parity(corpus):
+    mismatches = []
+    for _ in range(2):
+        for entry in corpus["queries"]:
+            result = parse_query(entry["query"])
+            if result != entry["result"]:
+                mismatches.append({"query": entry["query"], "expected": entry["result"], "result": result})
+
+        for entry in corpus["dates"]:
+            result = parse_date(entry["string"])
+            if result != entry["result"]:
+                mismatches.append({"date": entry["string"], "expected": entry["result"], "result": result})
+
+    return mismatches
+
+
+def bench_parser(corpus, repeat):
+    def measure(f, cached):
+        durations = []
+        for _ in range(repeat):
+            if not cached:
+                clear_caches()
+
+            time_start = time.perf_counter()
+            for entry in corpus["queries"]:
+                f(entry["query"])
+            durations.append(time.perf_counter() - time_start)
+
+        return statistics.median(durations) / len(corpus["queries"])
+
+    def parse_query_and_dates(query):
+        q = parse_query(query)
+        for k, v in q or []:
+            if k in ["date", "from", "to"]:
+                parse_date(v)
+
+    return {
+        "queries": len(corpus["queries"]),
+        "uncached": measure(parse_query_and_dates, False),
+        "cached": measure(parse_query_and_dates, True),
+    }
+
+
+class CliOptions(argparse.Namespace):
+    def __init__(self, args):
+        parser = argparse.ArgumentParser(description="MediaSurf query parser parity check and microbenchmark")
+        parser.add_argument("-c", "--corpus", default=Defaults.PATH_CORPUS, help="Path to the corpus of queries and their expected results")
+        parser.add_argument("-r", "--repeat", type=int, default=Defaults.REPEAT, help="Amount of times the corpus is parsed")
+        parser.add_argument("--check-only", action="store_true", help="Only check the parity of the parser with the corpus")
+
+        parser.parse_args(args, self)
+
+
+def main(av):
+    cli_options = CliOptions(av[1:])
+
+    # NOTE: some queries in the corpus are invalid on purpose
+    logging.basicConfig(level=logging.CRITICAL)
+
+    with open(cli_options.corpus) as fin:
+        corpus = json.load(fin)
+
+    report = {
+        "mismatches": check_parity(corpus),
+    }
+
+    if not cli_options.check_only:
+        report["seconds_per_query"] = bench_parser(corpus, cli_options.repeat)
+
+    json.dump(report, sys.stdout, indent=4)
+    print()
+
+    return 1 if report["mismatches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,33 +1,86 @@
 #!/usr/bin/env python3
 
+# NOTE: start of the import of the dependencies and the module itself, reported by `--profile-startup`
+import time
+TIME_IMPORT_START = time.perf_counter()
+
+import gc
+import io
 import os
 import sys
 import math
 import enum
+import gzip
+import mmap
+import json
+import array
+import queue
+import struct
+import pickle
+import signal
+import socket
 import urllib
+import shutil
 import hashlib
 import pathlib
 import inspect
 import logging
 import argparse
 import datetime
+import tempfile
+import functools
+import threading
 import itertools
+import contextlib
 import collections
+import wsgiref.util
+import importlib.util
+import collections.abc
 import multiprocessing
 
 # TODO: version dependencies statically
 import bottle
-import ffmpeg
 import PIL
-import PIL.Image
-import PIL.ExifTags
-import pyparsing as pp
 
-from bottle import get, static_file, request
-from bottle import mako_view
+from bottle import get, static_file, request, response
+from bottle import mako_template
 from bottle import HTTPError, HTTP_CODES
 
 
+# NOTE: the module is only loaded when one of its attributes is first accessed, but must be installed
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError("No module named %r" % name, name=name)
+
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+
+    return module
+
+
+# NOTE: those are only needed to index media, generate thumbnails and parse queries
+ffmpeg = lazy_import("ffmpeg")
+pp = lazy_import("pyparsing")
+lazy_import("PIL.Image")
+lazy_import("PIL.ExifTags")
+
+# NOTE: responses are only compressed with gzip when brotli isn't available
+try:
+    brotli = lazy_import("brotli")
+except ModuleNotFoundError:
+    brotli = None
+
+
 class HttpError(HTTPError):
     def __init__(self, status_code):
         super().__init__(status=status_code, body=HTTP_CODES[status_code])
@@ -73,6 +126,10 @@ def new_router():
     )
 
 
+def server_timings():
+    return request.environ.setdefault(MetricsPlugin.ENVIRON_KEY, collections.OrderedDict())
+
+
 def str2int(s):
     try:
         return int(s)
@@ -80,7 +137,14 @@ def str2int(s):
         return None
 
 
-@get("/static/<path:path>")
+def str2float(s):
+    try:
+        return float(s)
+    except (ValueError, TypeError):
+        return None
+
+
+@get("/static/<path:path>", name="static")
 def get_static_path(path):
     assert bottle.app().resources.path
     return static_file(path, root=bottle.app().resources.path[0])
@@ -102,7 +166,7 @@ def get_media_uuid(mdb, uuid_media, extension):
 # TODO: create a route without the extension to display an HTML page with details
 # NOTE: the extension is not used here, the file format is hardcoded
 @get("/media/<uuid_media>/thumbnail/<breakpoint>.<extension>", name="media_uuid_thumbnail")
-def get_media_uuid_thumbnail(mdb, uuid_media, breakpoint, extension):
+def get_media_uuid_thumbnail(mdb, metrics, uuid_media, breakpoint, extension):
     assert bottle.app().resources.path
 
     if uuid_media not in mdb.db:
@@ -111,28 +175,309 @@ def get_media_uuid_thumbnail(mdb, uuid_media, breakpoint, extension):
         raise HttpBadRequest()
 
     media = mdb.db[uuid_media]
-    name_thumbnail = "%s-%s" % (media.hash, breakpoint)
-    path_thumbnail = mdb.path_thumbnails / name_thumbnail
+    name_thumbnail = media.ThumbnailName(breakpoint)
 
-    logging.debug("path to thumbnail: %s", path_thumbnail)
+    path_thumbnail = mdb.thumbnails.Lookup(name_thumbnail)
+    if path_thumbnail is not None:
+        metrics.Increment("thumbnail_cache_hits", type=media.type, breakpoint=breakpoint)
+    else:
+        metrics.Increment("thumbnail_cache_misses", type=media.type, breakpoint=breakpoint)
+
+        try:
+            with metrics.Timer("thumbnail_generation", timings=server_timings(), type=media.type, breakpoint=breakpoint):
+                path_thumbnail = mdb.thumbnails.Generate(name_thumbnail,
+                                                         lambda path: media.CreateThumbnail(breakpoint, path))
+        except ThumbnailStoreError as e:
+            logging.warning("serving a placeholder thumbnail: %s", e)
 
-    if not path_thumbnail.exists():
-        if not media.CreateThumbnail(breakpoint, path_thumbnail):
+            metrics.Increment("thumbnail_placeholders", type=media.type, breakpoint=breakpoint)
+
+            # NOTE: the placeholder must not be cached, the thumbnail will be available later
+            r = static_file("image/placeholder.svg", root=bottle.app().resources.path[0])
+            r.set_header("Cache-Control", "no-store")
+            return r
+
+        if path_thumbnail is None:
             raise HttpInternalServerError()
 
-    return static_file(name_thumbnail, root=mdb.path_thumbnails)
+    logging.debug("path to thumbnail: %s", path_thumbnail)
+
+    return static_file(path_thumbnail.name, root=path_thumbnail.parent)
+
+
+# NOTE: the extension is not used here, the file format is hardcoded
+@get("/media/<uuid_media>/preview/<breakpoint>.<extension>", name="media_uuid_preview")
+def get_media_uuid_preview(mdb, metrics, previews, uuid_media, breakpoint, extension):
+    if uuid_media not in mdb.db or mdb.db[uuid_media].type != "video":
+        raise HttpNotFound()
+    elif breakpoint not in Media.BREAKPOINTS:
+        raise HttpBadRequest()
+
+    media = mdb.db[uuid_media]
+    url_original = bottle.app().get_url("media_uuid", uuid_media=uuid_media, extension=media.extension or media.format)
+
+    if not previews.Enabled():
+        bottle.redirect(url_original)
+
+    name_preview = media.PreviewName(breakpoint)
+
+    path_preview = previews.Lookup(name_preview)
+    if path_preview is None:
+        metrics.Increment("preview_cache_misses", breakpoint=breakpoint)
+
+        # NOTE: browsers don't retry sources, the original is played until the preview is transcoded in the background
+        previews.Submit(media, breakpoint)
+        bottle.redirect(url_original)
+
+    metrics.Increment("preview_cache_hits", breakpoint=breakpoint)
+
+    previews.Touch(name_preview)
+
+    return static_file(path_preview.name, root=path_preview.parent, mimetype="video/%s" % Video.FORMAT_PREVIEW)
 
 
 @get("/", name="index")
-@mako_view("index")
-def get_index(mdb):
-    # NOTE: dict values are a view, not a list, which aren't subscriptable
-    page = Page(list(mdb.db.values()), request)
+def get_index(mdb, metrics, previews):
+    timings = server_timings()
 
-    return {
-        "router": new_router(),
-        "page": page,
-    }
+    all_entries = mdb.Entries()
+
+    # NOTE: fragments that only depend on the media are rendered once per generation of the database
+    fragment = functools.partial(mdb.fragments.Get, mdb.generation)
+
+    page = Page(all_entries, request,
+                tag_sort_keys=fragment(("tag_sort_keys",), lambda: mdb.columns.TagSortKeys(all_entries)),
+                columns=mdb.columns)
+
+    for phase, duration in page.timings.items():
+        metrics.Observe("index_%s" % phase, duration)
+        timings["index_%s" % phase] = duration
+
+    with metrics.Timer("index_render", timings=timings):
+        return mako_template("index",
+                             router=new_router(),
+                             page=page,
+                             fragment=fragment,
+                             static_export=False,
+                             video_previews=previews.Enabled())
+
+
+@get("/metrics", name="metrics")
+def get_metrics(metrics):
+    response.content_type = Metrics.CONTENT_TYPE
+
+    return metrics.Render()
+
+
+class ThumbnailStoreError(Exception): pass
+
+
+# NOTE: thumbnails can be shared by several processes or hosts, only one of them generates a given thumbnail at a time
+class ThumbnailStore:
+    # NOTE: locks older than this are considered left behind by a process that crashed
+    DELAY_LOCK_STALE = 300
+    DELAY_LOCK_POLL = 0.1
+    DELAY_WAIT = 10
+
+    def __init__(self, path, sharded=False, path_local=None, timeout=DELAY_WAIT):
+        self.path = path
+        self.sharded = sharded
+        self.path_local = path_local
+        self.timeout = timeout
+
+    # NOTE: the sharded layout spreads the thumbnails over 65536 directories, according to the first characters of their hash,
+    # and applies to the local store as well
+    def _path(self, name, path_root=None):
+        path_root = path_root or self.path
+
+        if self.sharded:
+            return path_root / name[:2] / name[2:4] / name
+
+        return path_root / name
+
+    # NOTE: the temporary file is unique to the caller, several threads of the same process may copy the same thumbnail
+    @staticmethod
+    def _copy(path_source, path_destination):
+        path_destination.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, path_tmp = tempfile.mkstemp(prefix=".%s." % path_destination.name, suffix=".tmp", dir=path_destination.parent)
+        os.close(fd)
+
+        try:
+            shutil.copyfile(path_source, path_tmp)
+            os.replace(path_tmp, path_destination)
+        finally:
+            pathlib.Path(path_tmp).unlink(missing_ok=True)
+
+    # NOTE: the stale lock is moved out of the way before being removed, the rename is atomic so only one process claims
+    # it, which then makes sure it didn't claim a lock that replaced the stale one in the meantime
+    @staticmethod
+    def _reclaim(path_lock, st):
+        path_claimed = path_lock.with_name(".%s.%s.%d.%d.stale" % (path_lock.name, socket.gethostname(), os.getpid(),
+                                                                   threading.get_ident()))
+
+        try:
+            os.rename(path_lock, path_claimed)
+        except FileNotFoundError:
+            return
+
+        try:
+            st_claimed = path_claimed.stat()
+            if (st_claimed.st_ino, st_claimed.st_mtime) == (st.st_ino, st.st_mtime):
+                logging.warning("removed stale lock: %s", path_lock)
+                return
+
+            # NOTE: the lock is put back unless yet another process locked the thumbnail meanwhile
+            try:
+                os.link(path_claimed, path_lock)
+            except FileExistsError:
+                logging.warning("lost a live lock while removing a stale one: %s", path_lock)
+        finally:
+            path_claimed.unlink(missing_ok=True)
+
+    def _lock(self, path_lock):
+        try:
+            fd = os.open(path_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                st = path_lock.stat()
+            except FileNotFoundError:
+                return False
+
+            if time.time() - st.st_mtime > ThumbnailStore.DELAY_LOCK_STALE:
+                ThumbnailStore._reclaim(path_lock, st)
+
+            return False
+
+        with os.fdopen(fd, "w") as fout:
+            fout.write("%s:%d\n" % (socket.gethostname(), os.getpid()))
+
+        return True
+
+    def Contains(self, name):
+        return (self.path_local is not None and self._path(name, self.path_local).exists()) or self._path(name).exists()
+
+    # NOTE: `None` if the thumbnail isn't in the shared store
+    def Stat(self, name):
+        try:
+            return self._path(name).stat()
+        except FileNotFoundError:
+            return None
+
+    # NOTE: names and stats of the thumbnails of a flat store, temporary files and locks excluded
+    def List(self):
+        assert not self.sharded
+
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name.endswith(".lock"):
+                continue
+
+            try:
+                yield entry.name, entry.stat()
+            except FileNotFoundError:
+                pass
+
+    # NOTE: temporary files of a flat store that were left behind by processes that crashed
+    def RemoveLeftovers(self):
+        assert not self.sharded
+
+        time_stale = time.time() - ThumbnailStore.DELAY_LOCK_STALE
+
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if not entry.name.startswith(".") or not entry.name.endswith((".tmp", ".stale")):
+                continue
+
+            try:
+                if entry.stat().st_mtime < time_stale:
+                    logging.info("removing leftover temporary file: %s", entry.path)
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # NOTE: the modification time of the files of the shared store tells when they were last used
+    def Touch(self, name):
+        try:
+            os.utime(self._path(name))
+        except OSError as e:
+            logging.debug("unable to touch %s in the store: %s", name, e)
+
+    def Remove(self, name):
+        try:
+            if self.path_local is not None:
+                self._path(name, self.path_local).unlink(missing_ok=True)
+
+            self._path(name).unlink(missing_ok=True)
+        except OSError as e:
+            logging.warning("unable to remove %s from the store: %s", name, e)
+
+    # NOTE: thumbnails found in the shared store are copied to the local one, if any
+    def Lookup(self, name):
+        if self.path_local is not None:
+            path_local = self._path(name, self.path_local)
+            if path_local.exists():
+                return path_local
+
+        path = self._path(name)
+        if not path.exists():
+            return None
+
+        if self.path_local is None:
+            return path
+
+        try:
+            ThumbnailStore._copy(path, path_local)
+        except OSError as e:
+            logging.warning("unable to copy thumbnail to the local store: %s", e)
+            return path
+
+        return path_local
+
+    # NOTE: `create` is called with the path the thumbnail has to be written to, and returns whether that was successful
+    def Generate(self, name, create):
+        path = self._path(name)
+        path_lock = path.with_name("%s.lock" % path.name)
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+            time_limit = time.monotonic() + self.timeout
+            while not self._lock(path_lock):
+                if path.exists():
+                    return self.Lookup(name)
+                elif time.monotonic() > time_limit:
+                    raise ThumbnailStoreError("timed out waiting for another process to generate the thumbnail: %s" % name)
+
+                time.sleep(ThumbnailStore.DELAY_LOCK_POLL)
+
+            try:
+                # NOTE: the thumbnail might have been published between the lookup and the lock
+                if not path.exists():
+                    path_tmp = path.with_name(".%s.%s.%d.tmp" % (name, socket.gethostname(), os.getpid()))
+
+                    try:
+                        if not create(path_tmp):
+                            return None
+
+                        os.replace(path_tmp, path)
+                    finally:
+                        path_tmp.unlink(missing_ok=True)
+            finally:
+                path_lock.unlink(missing_ok=True)
+        except OSError as e:
+            logging.error("unable to store thumbnail: %s", e)
+            return None
+
+        return self.Lookup(name)
 
 
 class MediaError(Exception): pass
@@ -140,27 +485,75 @@ class MediaError(Exception): pass
 
 class Media:
     FORMAT_THUMBNAIL = "webp"
+    BREAKPOINTS = ["sm", "md", "lg", "xl", "xxl"]
+    # NOTE: size of the blocks sampled at the start, middle and end of the files to fingerprint them
+    SIZE_FINGERPRINT_BLOCK = 64 * 1024
+    SIZE_HASH_CHUNK = 1024 * 1024
 
     def __init__(self, path):
         self.path = path
         self.name = self.path.stem
         self.extension = self.path.suffix[1:]
         self.hash = None
+        # NOTE: media sharing a fingerprint are considered duplicates, and share their thumbnails
+        self.fingerprint = None
+        self.size = None
         self.resolution = None
         self.filetime = None
+        # NOTE: integer form of the date of `filetime`, used to filter entries without comparing datetimes
+        self.filetime_key = None
         self.tags = {}
         self.format = None
 
         # NOTE: This field is used by the view templates to avoid type introspection
         self.type = None
 
-    def _hash(self, filename, filesize, width, height, format):
+        # NOTE: amount of thumbnails generated while indexing the media, if requested
+        self.count_thumbnails = 0
+
+    # NOTE: the hash identifies the file itself, so that copies of a media in different directories remain distinct entries
+    def _hash(self):
         h = hashlib.sha1()
-        h_data = "%s-%d-%d.%d-%s" % (filename, filesize, width, height, format)
+        h_data = "%s-%s" % (self.path, self.fingerprint)
         h.update(h_data.encode())
 
         return h.hexdigest()
 
+    # NOTE: only the size and a few blocks are read, files that only differ elsewhere are told apart by `ContentHash`
+    def _fingerprint(self):
+        h = hashlib.sha1()
+        h.update(b"%d" % self.size)
+
+        with open(self.path, "rb") as fin:
+            if self.size <= 3 * Media.SIZE_FINGERPRINT_BLOCK:
+                h.update(fin.read())
+            else:
+                for offset in [0, (self.size - Media.SIZE_FINGERPRINT_BLOCK) // 2, self.size - Media.SIZE_FINGERPRINT_BLOCK]:
+                    fin.seek(offset)
+                    h.update(fin.read(Media.SIZE_FINGERPRINT_BLOCK))
+
+        return h.hexdigest()
+
+    def _identify(self, size):
+        self.size = size
+        self.fingerprint = self._fingerprint()
+        self.hash = self._hash()
+
+    def ContentHash(self):
+        h = hashlib.sha1()
+
+        with open(self.path, "rb") as fin:
+            for chunk in iter(functools.partial(fin.read, Media.SIZE_HASH_CHUNK), b""):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def ThumbnailName(self, breakpoint):
+        return "%s-%s" % (self.fingerprint, breakpoint)
+
+    def PreviewName(self, breakpoint):
+        return "%s-preview-%s" % (self.fingerprint, breakpoint)
+
     def ThumbnailResolution(self, breakpoint):
         def scale_resolution(target_width, resolution):
             if resolution[0] < target_width:
@@ -172,7 +565,7 @@ class Media:
 
         resolution = self.resolution
 
-        assert resolution is not None and breakpoint in ["sm", "md", "lg", "xl", "xxl"]
+        assert resolution is not None and breakpoint in Media.BREAKPOINTS
 
         if breakpoint == "sm":
             # NOTE: under this breakpoint, all pictures are shown on their own column
@@ -200,18 +593,79 @@ class Media:
 
         return resolution
 
+    def _save_thumbnail(self, im, breakpoint, path_thumbnail, format_thumbnail=FORMAT_THUMBNAIL):
+        resolution = self.ThumbnailResolution(breakpoint)
+
+        logging.debug("target thumbnail resolution: %d / %d", *resolution)
+
+        try:
+            im.thumbnail(size=resolution, resample=PIL.Image.LANCZOS)
+
+            im.save(path_thumbnail, format=format_thumbnail)
+        except (ValueError, OSError) as e:
+            logging.error("unable to generate thumbnail: %s", e)
+            return False
+
+        return True
+
+    def _missing_thumbnails(self, thumbnails):
+        return [breakpoint for breakpoint in Media.BREAKPOINTS
+                if not thumbnails.Contains(self.ThumbnailName(breakpoint))]
+
+    # NOTE: all the thumbnails are scaled down from the same decoded image, which is only read once
+    def _create_thumbnails(self, im, thumbnails, breakpoints):
+        if not breakpoints:
+            return 0
+
+        # NOTE: failing to generate thumbnails doesn't prevent the media from being indexed
+        try:
+            im.load()
+        except OSError as e:
+            logging.error("unable to decode media: %s", e)
+            return 0
+
+        count_generated = 0
+        for breakpoint in breakpoints:
+            logging.debug("generating thumbnail for breakpoint %s: %s", breakpoint, self.path)
+
+            try:
+                if thumbnails.Generate(self.ThumbnailName(breakpoint),
+                                       lambda path: self._save_thumbnail(im.copy(), breakpoint, path)) is not None:
+                    count_generated += 1
+            except ThumbnailStoreError as e:
+                logging.warning("unable to generate thumbnail: %s", e)
+
+        return count_generated
+
     def CreateThumbnail(self, breakpoint, path_thumbnail, format_thumbnail=FORMAT_THUMBNAIL):
         pass
 
+    # NOTE: `processes` is a set the ffmpeg process is kept in while it runs, so that it can be terminated by another thread
+    def CreatePreview(self, breakpoint, path_preview, processes=None):
+        return False
+
 
 class Video(Media):
-    def __init__(self, path):
+    FORMAT_PREVIEW = "mp4"
+    # NOTE: previews only cover the start of the videos, in seconds
+    DURATION_PREVIEW = 10
+    BITRATES_PREVIEW = {
+        "sm": "300k",
+        "md": "600k",
+        "lg": "800k",
+        "xl": "1000k",
+        "xxl": "1200k",
+    }
+
+    # NOTE: when a thumbnail store is passed, the thumbnails missing from it are generated right after probing the file
+    def __init__(self, path, thumbnails=None):
         super().__init__(path)
 
         self.type = "video"
 
         st = self.path.stat()
         self.filetime = DatetimeWrapper(dt=datetime.datetime.fromtimestamp(st.st_ctime))
+        self.filetime_key = DatetimeWrapper.DateKey(self.filetime)
 
         try:
             probe = ffmpeg.probe(self.path)
@@ -229,7 +683,33 @@ class Video(Media):
             self.tags.update(stream.get("tags", {}))
         self.tags.update(probe["format"].get("tags", {}))
 
-        self.hash = self._hash(self.name, str2int(probe["format"]["size"]), self.resolution[0], self.resolution[1], self.format)
+        try:
+            self._identify(st.st_size)
+        except OSError as e:
+            raise MediaError("unable to fingerprint video: %s" % e)
+
+        if thumbnails is not None:
+            self.count_thumbnails = self._create_poster_thumbnails(thumbnails, self._missing_thumbnails(thumbnails))
+
+    # NOTE: the poster is decoded once, then scaled down for every breakpoint
+    def _create_poster_thumbnails(self, thumbnails, breakpoints):
+        if not breakpoints:
+            return 0
+
+        try:
+            poster, _ = ffmpeg.input(self.path) \
+                              .output("pipe:", format="image2", vcodec="png", vframes=1) \
+                              .run(capture_stdout=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            logging.error("unable to extract poster: %s", e.stderr)
+            return 0
+
+        try:
+            with PIL.Image.open(io.BytesIO(poster)) as im:
+                return self._create_thumbnails(im, thumbnails, breakpoints)
+        except (ValueError, OSError, PIL.UnidentifiedImageError) as e:
+            logging.error("unable to decode poster: %s", e)
+            return 0
 
     def CreateThumbnail(self, breakpoint, path_thumbnail, format_thumbnail=Media.FORMAT_THUMBNAIL):
         logging.debug("generating thumbnail for breakpoint %s: %s", breakpoint, path_thumbnail)
@@ -248,9 +728,47 @@ class Video(Media):
 
         return True
 
+    def CreatePreview(self, breakpoint, path_preview, processes=None):
+        logging.debug("transcoding preview for breakpoint %s: %s", breakpoint, path_preview)
+
+        resolution = self.ThumbnailResolution(breakpoint)
+        bitrate = Video.BITRATES_PREVIEW[breakpoint]
+
+        logging.debug("target preview resolution and bitrate: %d / %d, %s", *resolution, bitrate)
+
+        # NOTE: the encoder requires even dimensions, the previews are muted in the gallery
+        try:
+            process = ffmpeg.input(self.path, t=Video.DURATION_PREVIEW).filter("scale", int(resolution[0]) // 2 * 2, -2) \
+                            .output(filename=path_preview, format=Video.FORMAT_PREVIEW, vcodec="libx264", preset="veryfast",
+                                    pix_fmt="yuv420p", video_bitrate=bitrate, maxrate=bitrate, bufsize=bitrate,
+                                    movflags="+faststart", an=None).overwrite_output() \
+                            .run_async(pipe_stdout=True, pipe_stderr=True)
+        except OSError as e:
+            logging.error("unable to transcode preview: %s", e)
+            return False
+
+        if processes is not None:
+            processes.add(process)
+
+        try:
+            _, stderr = process.communicate()
+        finally:
+            if processes is not None:
+                processes.discard(process)
+
+        if process.returncode < 0:
+            logging.info("transcoding of preview interrupted: %s", path_preview)
+            return False
+        elif process.returncode:
+            logging.error("unable to transcode preview: %s", stderr)
+            return False
+
+        return True
+
 
 class Image(Media):
-    def __init__(self, path):
+    # NOTE: when a thumbnail store is passed, the thumbnails missing from it are generated from the file opened to index it
+    def __init__(self, path, thumbnails=None):
         super().__init__(path)
 
         self.type = "image"
@@ -258,6 +776,7 @@ class Image(Media):
         try:
             st = self.path.stat()
             self.filetime = DatetimeWrapper(dt=datetime.datetime.fromtimestamp(st.st_ctime))
+            self.filetime_key = DatetimeWrapper.DateKey(self.filetime)
 
             with PIL.Image.open(self.path) as im:
                 self.resolution = im.size
@@ -269,28 +788,23 @@ class Image(Media):
                     else:
                         logging.warning("unknown tag index: %s", k)
 
-                self.hash = self._hash(self.name, st.st_size, im.width, im.height, im.format)
+                self._identify(st.st_size)
+
+                if thumbnails is not None:
+                    self.count_thumbnails = self._create_thumbnails(im, thumbnails, self._missing_thumbnails(thumbnails))
         except (FileNotFoundError, ValueError, TypeError, OSError, PIL.UnidentifiedImageError) as e:
             raise MediaError("unable to open image: %s" % e)
 
     def CreateThumbnail(self, breakpoint, path_thumbnail, format_thumbnail=Media.FORMAT_THUMBNAIL):
         logging.debug("generating thumbnail for breakpoint %s: %s", breakpoint, path_thumbnail)
 
-        resolution = self.ThumbnailResolution(breakpoint)
-
-        logging.debug("target thumbnail resolution: %d / %d", *resolution)
-
         try:
             with PIL.Image.open(self.path) as im:
-                im.thumbnail(size=resolution, resample=PIL.Image.LANCZOS)
-
-                im.save(path_thumbnail, format=format_thumbnail)
+                return self._save_thumbnail(im, breakpoint, path_thumbnail, format_thumbnail)
         except (ValueError, OSError) as e:
             logging.error("unable to generate thumbnail: %s", e)
             return False
 
-        return True
-
 
 class DateHints(enum.Flag):
     YEAR = enum.auto()
@@ -316,13 +830,28 @@ class DatetimeWrapper(datetime.datetime):
         return "%s, %s" % (super().__str__(), self.hints)
 
     def __eq__(self, other):
-        values = []
-        for i in [i for i in list(DateHints) if i in self.hints]:
-            values.append((getattr(self, i.name.lower()), getattr(other, i.name.lower())))
+        return all(getattr(self, i.name.lower()) == getattr(other, i.name.lower()) for i in DateHints if i in self.hints)
 
-        logging.debug("equal date values: %s", values)
+    # NOTE: dates are reduced to integers of the form YYYYMMDD, which preserves their order
+    @staticmethod
+    def DateKey(dt):
+        return dt.year * 10000 + dt.month * 100 + dt.day
+
+    # NOTE: the range of date keys covered by the date, according to the hints, following the formats implemented in QueryParser
+    def DateKeyRange(self):
+        if DateHints.YEAR | DateHints.MONTH | DateHints.DAY in self.hints:
+            key = DatetimeWrapper.DateKey(self)
+            return key, key
+        elif DateHints.YEAR | DateHints.MONTH in self.hints:
+            key = self.year * 10000 + self.month * 100
+            return key, key + 99
+        elif DateHints.YEAR in self.hints:
+            key = self.year * 10000
+            return key, key + 9999
+
+        logging.warning("unsupported combination of hints: %s", self.hints)
 
-        return next((True for a, b in values if a != b), None) is None
+        return None
 
     # NOTE: the following operators follow the date formats implemented in QueryParser
     def __le__(self, other):
@@ -367,7 +896,8 @@ class DatetimeWrapper(datetime.datetime):
             logging.warning("unsupported combination of hints: %s/%s", self.hints, other.hints)
 
 
-class Date(pp.ParserElement):
+# NOTE: pyparsing is loaded when the first query is parsed, the elements derive from its base class then, see `Element`
+class Date:
     DATE_FORMAT = "%a %b %d %H:%M:%S %Y"
     DATE_FORMAT_HINTS = (
         DateHints.YEAR
@@ -391,7 +921,19 @@ class Date(pp.ParserElement):
         self.name = "Date"
         self.errmsg = "Expected %s" % self.name
 
-    def _match_datetime(self, s, format):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _element_class():
+        return type("DateElement", (Date, pp.ParserElement), {})
+
+    @staticmethod
+    def Element(format=DATE_FORMAT, format_hints=DATE_FORMAT_HINTS, delim=STR_DELIM, max_delim=MAX_DELIM):
+        return Date._element_class()(format, format_hints, delim, max_delim)
+
+    # NOTE: the same substrings are probed repeatedly while looking for a delimiter, across alternatives and queries
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _match_datetime(s, format):
         try:
             datetime.datetime.strptime(s, format)
             return True
@@ -419,79 +961,114 @@ class QueryError(Exception): pass
 
 
 class QueryParser(collections.OrderedDict):
-    TAG_TOKEN = (
-        pp.Keyword("tag") + pp.Suppress(":") + pp.Word(pp.alphas, pp.alphanums + "_")
-    )
+    # TODO: date, from, to should be able to grab dates in EXIF tags
 
-    SORT_TOKEN = (
-        pp.Keyword("sort") + pp.Suppress(":")
-        + (pp.Keyword("name") | pp.Keyword("date") | TAG_TOKEN)
-        + pp.Optional(
-            pp.Suppress(":") + pp.oneOf("s n d"),
-            default="s",
-        )
-        + pp.Optional(
-            pp.Suppress(pp.Keyword("order")) + pp.Suppress(":") + (pp.Keyword("asc") | pp.Keyword("desc")),
-            default="desc",
+    # TODO: support quoted %c datetimes
+    # TODO: support quoted datetimes with hour/minute/second individually
+    DATETIME_FORMATS = [
+        ("%Y/%m/%d", DateHints.YEAR | DateHints.MONTH | DateHints.DAY),
+        ("%Y/%m", DateHints.YEAR | DateHints.MONTH),
+        ("%Y", DateHints.YEAR),
+    ]
+
+    # NOTE: the grammar is built when the first query is parsed, rather than when the module is imported
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def Grammar():
+        TAG_TOKEN = (
+            pp.Keyword("tag") + pp.Suppress(":") + pp.Word(pp.alphas, pp.alphanums + "_")
         )
-    )
 
-    SEARCH_TOKEN = (
-        (
-            (pp.Keyword("name") | pp.Keyword("date"))
-            + pp.Suppress(":")
-            + (pp.Word(pp.printables)
-               | pp.dblQuotedString().setParseAction(pp.removeQuotes)
-               | pp.sglQuotedString().setParseAction(pp.removeQuotes))
-        ) | (
-            TAG_TOKEN
+        SORT_TOKEN = (
+            pp.Keyword("sort") + pp.Suppress(":")
+            + (pp.Keyword("name") | pp.Keyword("date") | TAG_TOKEN)
+            + pp.Optional(
+                pp.Suppress(":") + pp.oneOf("s n d"),
+                default="s",
+            )
             + pp.Optional(
-                pp.Suppress(":")
+                pp.Suppress(pp.Keyword("order")) + pp.Suppress(":") + (pp.Keyword("asc") | pp.Keyword("desc")),
+                default="desc",
+            )
+        )
+
+        SEARCH_TOKEN = (
+            (
+                (pp.Keyword("name") | pp.Keyword("date"))
+                + pp.Suppress(":")
                 + (pp.Word(pp.printables)
                    | pp.dblQuotedString().setParseAction(pp.removeQuotes)
                    | pp.sglQuotedString().setParseAction(pp.removeQuotes))
+            ) | (
+                TAG_TOKEN
+                + pp.Optional(
+                    pp.Suppress(":")
+                    + (pp.Word(pp.printables)
+                       | pp.dblQuotedString().setParseAction(pp.removeQuotes)
+                       | pp.sglQuotedString().setParseAction(pp.removeQuotes))
+                )
             )
         )
-    )
 
-    # TODO: date, from, to should be able to grab dates in EXIF tags
+        DATETIME = pp.MatchFirst([Date.Element(format, hints) for format, hints in QueryParser.DATETIME_FORMATS])
+        FROM_TOKEN = (
+            pp.Keyword("from") + pp.Suppress(":") + DATETIME
+        )
+        TO_TOKEN = (
+            pp.Keyword("to") + pp.Suppress(":") + DATETIME
+        )
 
-    # TODO: support quoted %c datetimes
-    # TODO: support quoted datetimes with hour/minute/second individually
-    DATETIME = (
-        Date("%Y/%m/%d", DateHints.YEAR | DateHints.MONTH | DateHints.DAY)
-        | Date("%Y/%m", DateHints.YEAR | DateHints.MONTH)
-        | Date("%Y", DateHints.YEAR)
-    )
-    FROM_TOKEN = (
-        pp.Keyword("from") + pp.Suppress(":") + DATETIME
-    )
-    TO_TOKEN = (
-        pp.Keyword("to") + pp.Suppress(":") + DATETIME
-    )
+        TYPE_TOKEN = (
+            pp.Keyword("type") + pp.Suppress(":")
+            + (pp.Keyword("image") | pp.Keyword("video"))
+        )
 
-    TYPE_TOKEN = (
-        pp.Keyword("type") + pp.Suppress(":")
-        + (pp.Keyword("image") | pp.Keyword("video"))
-    )
+        QUERY_TOKEN = pp.Group(SORT_TOKEN | SEARCH_TOKEN | FROM_TOKEN | TO_TOKEN | TYPE_TOKEN)
 
-    QUERY_TOKEN = pp.Group(SORT_TOKEN | SEARCH_TOKEN | FROM_TOKEN | TO_TOKEN | TYPE_TOKEN)
+        return pp.Dict(pp.OneOrMore(QUERY_TOKEN))
 
-    GRAMMAR = pp.Dict(pp.OneOrMore(QUERY_TOKEN))
+    # NOTE: standalone matchers, used to cast the dates in predicates without copying the grammar
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def DatetimeMatchers():
+        return [Date.Element(format, hints) for format, hints in QueryParser.DATETIME_FORMATS]
 
-    def __init__(self, s, grammar=GRAMMAR):
+    def __init__(self, s, grammar=None):
         try:
-            r = grammar.setDebug(logging.getLogger().isEnabledFor(logging.DEBUG)).parseString(s, parseAll=True)
+            grammar = grammar or QueryParser.Grammar()
+            grammar.setDebug(logging.getLogger().isEnabledFor(logging.DEBUG))
 
-            logging.debug("search query parse results: %s", r)
-
-            self.update(collections.OrderedDict(r))
+            self.update(QueryParser._parse(s, grammar))
         except (Exception, pp.ParseException, pp.RecursiveGrammarException, pp.ParseFatalException, pp.ParseSyntaxException) as e:
             raise QueryError("unable to parse query: %s" % e)
 
+    # NOTE: the same queries come back with every page change, only failures are parsed again
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _parse(s, grammar):
+        r = grammar.parseString(s, parseAll=True)
+
+        logging.debug("search query parse results: %s", r)
+
+        return tuple(collections.OrderedDict(r).items())
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def ParseDate(s):
+        for d in QueryParser.DatetimeMatchers():
+            try:
+                d.parseString(s, parseAll=True)
+                return DatetimeWrapper(dt=datetime.datetime.strptime(s, d.format), hints=d.format_hints)
+            except pp.ParseException:
+                pass
+
+        return None
+
 
 class Page:
-    def __init__(self, all_entries, request):
+    # NOTE: `url_for` builds the URL of a page from query string parameters, the URL of the request is used by default
+    # NOTE: `columns` reads the fields of the entries, which are media, or rows of a published index
+    def __init__(self, all_entries, request, url_for=None, tag_sort_keys=None, columns=None):
         logging.debug("Request form filters: %r", [(k, v) for k, v in request.query.items()])
 
         def cast_integer(s):
@@ -502,13 +1079,9 @@ class Page:
             return 0
 
         def cast_date(s):
-            for D in QueryParser.DATETIME().streamline().exprs:
-                try:
-                    d = D()
-                    d.parseString(s, parseAll=True)
-                    return DatetimeWrapper(dt=datetime.datetime.strptime(s, d.format), hints=d.format_hints)
-                except pp.ParseException:
-                    pass
+            d = QueryParser.ParseDate(s)
+            if d is not None:
+                return d
             logging.warning("unable to cast string as date: %s", s)
             return datetime.datetime.fromtimestamp(0)
 
@@ -531,14 +1104,31 @@ class Page:
         elif self.limit < 10:
             self.limit = 10
 
+        # NOTE: time spent in each phase of the query, in seconds
+        self.timings = collections.OrderedDict([
+            ("parse", 0.0),
+            ("filter", 0.0),
+            ("sort", 0.0),
+        ])
+
+        self.columns = columns
+        if self.columns is None:
+            self.columns = MediaColumns()
+
         self.all_entries = all_entries
-        self.tag_sort_keys = sorted(set(itertools.chain(*[p.tags.keys() for p in all_entries])), key=lambda x: x.lower())
+        self.tag_sort_keys = tag_sort_keys
+        if self.tag_sort_keys is None:
+            self.tag_sort_keys = self.columns.TagSortKeys(all_entries)
 
         # TODO: fuzzy matching
         self.search_query = request.query.get("search")
         if self.search_query:
             try:
-                q = QueryParser(self.search_query)
+                time_start = time.perf_counter()
+                try:
+                    q = QueryParser(self.search_query)
+                finally:
+                    self.timings["parse"] += time.perf_counter() - time_start
 
                 logging.info("search query: %s", q)
 
@@ -549,6 +1139,8 @@ class Page:
                 }
 
                 for name_filter, predicate in q.items():
+                    time_start = time.perf_counter()
+
                     logging.debug("filter: %s", name_filter)
                     logging.debug("predicate: %s", predicate)
 
@@ -556,11 +1148,11 @@ class Page:
                         if isinstance(predicate, str):
                             logging.debug("filtering by tag: %s", predicate)
 
-                            self.all_entries = list(filter(lambda x: predicate in x.tags, self.all_entries))
+                            self.all_entries = self.columns.FilterTag(self.all_entries, predicate)
                         else:
                             logging.debug("filtering by tag and value: %s", predicate)
 
-                            self.all_entries = list(filter(lambda x: str(x.tags.get(predicate[0], "")) == predicate[1], self.all_entries))
+                            self.all_entries = self.columns.FilterTagValue(self.all_entries, predicate[0], predicate[1])
                     elif name_filter == "sort":
                         key = predicate[0]
 
@@ -579,60 +1171,50 @@ class Page:
                             if cast == "d":
                                 # NOTE: the datetimes in EXIF tags have a standard format
                                 f_cast = cast_exif_date
-                            self.all_entries = sorted(self.all_entries,
-                                                      key=lambda x: f_cast(x.tags.get(predicate[1], "")),
-                                                      reverse=order == "desc")
+                            self.all_entries = self.columns.SortTag(self.all_entries, predicate[1], f_cast, order == "desc")
                         elif key == "name":
-                            self.all_entries = sorted(self.all_entries,
-                                                      key=lambda x: f_cast(x.name),
-                                                      reverse=order == "desc")
+                            self.all_entries = self.columns.SortName(self.all_entries, f_cast, order == "desc")
                         elif key == "date":
                             # NOTE: we don't cast here because there's no use serialising a datetime object
-                            self.all_entries = sorted(self.all_entries,
-                                                      key=lambda x: x.filetime,
-                                                      reverse=order == "desc")
+                            self.all_entries = self.columns.SortDate(self.all_entries, order == "desc")
                         else:
                             logging.error("sorting predicate unsupported: %s", name_filter)
                     elif name_filter == "name":
                         logging.debug("filtering by name: %s", predicate)
 
-                        self.all_entries = list(filter(lambda x: predicate.lower() in x.name.lower(),
-                                                  self.all_entries))
-                    elif name_filter == "date":
-                        logging.debug("filtering by date: %s", predicate)
+                        self.all_entries = self.columns.FilterName(self.all_entries, predicate.lower())
+                    elif name_filter in ["date", "from", "to"]:
+                        logging.debug("filtering by date, %s: %s", name_filter, predicate)
 
                         date_predicate = cast_date(predicate)
                         logging.debug("date predicate: %s", date_predicate)
-                        self.all_entries = list(filter(lambda x: date_predicate == x.filetime,
-                                                  self.all_entries))
-                    elif name_filter == "from":
-                        logging.debug("filtering by date, from: %s", predicate)
 
-                        date_predicate = cast_date(predicate)
-                        logging.debug("date predicate: %s", date_predicate)
-                        self.all_entries = list(filter(lambda x: x.filetime >= date_predicate,
-                                                  self.all_entries))
-                    elif name_filter == "to":
-                        logging.debug("filtering by date, to: %s", predicate)
+                        # NOTE: the predicate is compiled into a range of date keys once, the entries are then compared as integers
+                        key_range = date_predicate.DateKeyRange() if isinstance(date_predicate, DatetimeWrapper) else None
+                        logging.debug("date key range: %s", key_range)
 
-                        date_predicate = cast_date(predicate)
-                        logging.debug("date predicate: %s", date_predicate)
-                        self.all_entries = list(filter(lambda x: x.filetime <= date_predicate,
-                                                  self.all_entries))
+                        if key_range is None:
+                            self.all_entries = []
+                        elif name_filter == "date":
+                            self.all_entries = self.columns.FilterDateKeys(self.all_entries, *key_range)
+                        elif name_filter == "from":
+                            self.all_entries = self.columns.FilterDateKeys(self.all_entries, key_range[0], math.inf)
+                        else:
+                            self.all_entries = self.columns.FilterDateKeys(self.all_entries, -math.inf, key_range[1])
                     elif name_filter == "type":
                         logging.debug("filtering by filetype: %s", predicate)
-                        class_filter = Image if predicate == "image" else Video
-                        self.all_entries = list(filter(lambda x: isinstance(x, class_filter),
-                                                  self.all_entries))
+                        self.all_entries = self.columns.FilterType(self.all_entries, "image" if predicate == "image" else "video")
                     else:
                         logging.error("unsupported filter: %s", name_filter)
+
+                    self.timings["sort" if name_filter == "sort" else "filter"] += time.perf_counter() - time_start
             except QueryError as e:
                 logging.error("couldn't parse query: %s", e)
                 # TODO: signal to the UI that the query is incorrect
 
         self.all_entries_count = len(self.all_entries)
 
-        self.entries = self.all_entries[self.page_offset * self.limit:(self.page_offset + 1) * self.limit]
+        self.entries = self.columns.Media(self.all_entries[self.page_offset * self.limit:(self.page_offset + 1) * self.limit])
         self.entries_count = len(self.entries)
 
         self.pages_count = math.ceil(self.all_entries_count / self.limit)
@@ -649,29 +1231,110 @@ class Page:
 
             return urllib.parse.urlunparse(url._replace(query=urllib.parse.urlencode(qs, doseq=True)))
 
-        url = urllib.parse.urlparse(request.url)
+        if url_for is None:
+            url = urllib.parse.urlparse(request.url)
+            url_for = functools.partial(edit_url_qs, url)
 
-        self.url_first_page = edit_url_qs(url, page=1)
-        self.url_last_page = edit_url_qs(url, page=self.pages_count)
+        self.url_first_page = url_for(page=1)
+        self.url_last_page = url_for(page=self.pages_count)
 
         if self.has_previous_page:
-            self.url_previous_page = edit_url_qs(url, page=self.page - 1)
+            self.url_previous_page = url_for(page=self.page - 1)
 
         if self.has_next_page:
-            self.url_next_page = edit_url_qs(url, page=self.page + 1)
+            self.url_next_page = url_for(page=self.page + 1)
 
-        self.url_limit = lambda x: edit_url_qs(url, limit=x, page=1)
+        self.url_limit = lambda x: url_for(limit=x, page=1)
 
 
-class MediaDatabaseError(Exception): pass
+# NOTE: fields of entries that are media objects, filtered and sorted by `Page`
+class MediaColumns:
+    def FilterTag(self, entries, key):
+        return [x for x in entries if key in x.tags]
 
+    def FilterTagValue(self, entries, key, value):
+        return [x for x in entries if str(x.tags.get(key, "")) == value]
 
-class MediaDatabase:
-    EXTENSIONS_IMAGE = [
-        "blp",
-        "bmp",
-        "cur",
-        "dcx",
+    def FilterName(self, entries, name):
+        return [x for x in entries if name in x.name.lower()]
+
+    def FilterDateKeys(self, entries, key_min, key_max):
+        return [x for x in entries if key_min <= x.filetime_key <= key_max]
+
+    def FilterType(self, entries, type):
+        class_filter = Image if type == "image" else Video
+        return [x for x in entries if isinstance(x, class_filter)]
+
+    def SortTag(self, entries, key, cast, reverse=False):
+        return sorted(entries, key=lambda x: cast(x.tags.get(key, "")), reverse=reverse)
+
+    def SortName(self, entries, cast, reverse=False):
+        return sorted(entries, key=lambda x: cast(x.name), reverse=reverse)
+
+    def SortDate(self, entries, reverse=False):
+        return sorted(entries, key=lambda x: x.filetime, reverse=reverse)
+
+    def TagSortKeys(self, entries):
+        return sorted(set(itertools.chain(*[p.tags.keys() for p in entries])), key=lambda x: x.lower())
+
+    def Media(self, entries):
+        return list(entries)
+
+
+# NOTE: rendered fragments are keyed by the generation of the database they were rendered from, older ones expire eventually
+class FragmentCache:
+    # NOTE: maximum size of the fragments held, in bytes, cards weigh a few KiB each, so this holds a few dozen pages worth
+    SIZE = 8 * 1024 * 1024
+
+    def __init__(self, size=SIZE, metrics=None):
+        self.size = size
+        self.metrics = metrics or Metrics()
+
+        self.lock = threading.Lock()
+        self.fragments = collections.OrderedDict()
+        self.size_fragments = 0
+
+    # NOTE: the first item of the key names the kind of fragment, for the metrics
+    def Get(self, generation, key, render):
+        key_cache = (generation,) + key
+
+        with self.lock:
+            if key_cache in self.fragments:
+                self.fragments.move_to_end(key_cache)
+                self.metrics.Increment("fragment_cache_hits", fragment=key[0])
+                return self.fragments[key_cache]
+
+        self.metrics.Increment("fragment_cache_misses", fragment=key[0])
+
+        # NOTE: concurrent requests might render the same fragment, which is cheaper than rendering under the lock
+        fragment = render()
+
+        # NOTE: the size of fragments that aren't strings (e.g. lists) only accounts for the container, which is negligible
+        size = sys.getsizeof(fragment)
+
+        with self.lock:
+            if key_cache not in self.fragments:
+                self.fragments[key_cache] = fragment
+                self.size_fragments += size
+
+            while self.size_fragments > self.size and len(self.fragments) > 1:
+                _, fragment_evicted = self.fragments.popitem(last=False)
+                self.size_fragments -= sys.getsizeof(fragment_evicted)
+
+            self.metrics.Set("fragment_cache_bytes", self.size_fragments)
+
+        return fragment
+
+
+class MediaDatabaseError(Exception): pass
+
+
+class MediaDatabase:
+    EXTENSIONS_IMAGE = [
+        "blp",
+        "bmp",
+        "cur",
+        "dcx",
         "dds",
         "dib",
         "eps",
@@ -734,12 +1397,18 @@ class MediaDatabase:
 
     def _append_media_done(self, media):
         if media is not None:
-            # NOTE: we use a hash generated by the object itself to be able to lookup thumbnails easily
+            # NOTE: the hash identifies the entry (its path and content), thumbnails are named after the content fingerprint instead
             self.db[media.hash] = media
 
+            self.metrics.Increment("index_media", type=media.type)
+            if media.count_thumbnails:
+                self.metrics.Increment("index_thumbnails", media.count_thumbnails, type=media.type)
+        else:
+            self.metrics.Increment("index_skipped")
+
     # NOTE: The function cannot be a member function because of multi-processing
     @staticmethod
-    def _append_media(path_file):
+    def _append_media(path_file, thumbnails=None):
         logging.info("identifying media: %s", path_file)
 
         if not path_file.suffix:
@@ -760,7 +1429,7 @@ class MediaDatabase:
         try:
             logging.info("loading media: %s", path_file)
 
-            return ctor(path_file)
+            return ctor(path_file, thumbnails)
         except MediaError as e:
             logging.error("unable to assign the media to the database: %s", e)
 
@@ -773,6 +1442,50 @@ class MediaDatabase:
 
         return results
 
+    # NOTE: media whose sampled fingerprints match are hashed entirely, those that turn out to differ get their own fingerprint
+    def _verify_duplicates(self, pool, duplicates):
+        medias = [media for group in duplicates.values() for media in group]
+        if not medias:
+            return
+
+        content_hashes = dict(zip((media.hash for media in medias), pool.map(Media.ContentHash, medias)))
+
+        for group in duplicates.values():
+            if len(set(content_hashes[media.hash] for media in group)) == 1:
+                continue
+
+            logging.warning("media share a sampled fingerprint without being identical: %s",
+                            ", ".join(str(media.path) for media in group))
+
+            for media in group:
+                media.fingerprint = content_hashes[media.hash]
+
+    def _collapse_duplicates(self, pool):
+        fingerprints = collections.defaultdict(list)
+        for media in self.db.values():
+            fingerprints[media.fingerprint].append(media)
+
+        if self.verify_duplicates:
+            self._verify_duplicates(pool, {k: v for k, v in fingerprints.items() if len(v) > 1})
+
+            fingerprints.clear()
+            for media in self.db.values():
+                fingerprints[media.fingerprint].append(media)
+
+        for group in fingerprints.values():
+            for media in group[1:]:
+                self.stats["duplicates"] += 1
+                self.stats["duplicates_bytes"] += media.size
+                self.stats["thumbnails_saved"] += len(Media.BREAKPOINTS)
+
+        self.metrics.Set("database_duplicates", self.stats["duplicates"])
+        self.metrics.Set("database_duplicates_bytes", self.stats["duplicates_bytes"])
+        self.metrics.Set("database_thumbnails_saved", self.stats["thumbnails_saved"])
+
+        if self.stats["duplicates"]:
+            logging.info("found %d duplicate media (%d bytes), sharing thumbnails saves %d of them",
+                         self.stats["duplicates"], self.stats["duplicates_bytes"], self.stats["thumbnails_saved"])
+
     def _resolve_path(self, pool, path):
         logging.debug("resolving path: %s", path)
 
@@ -780,7 +1493,8 @@ class MediaDatabase:
             raise MediaDatabaseError(e)
 
         if path.is_file():
-            result = pool.apply_async(MediaDatabase._append_media, (path,),
+            result = pool.apply_async(MediaDatabase._append_media,
+                                      (path, self.thumbnails if self.generate_thumbnails else None),
                                       callback=self._append_media_done,
                                       error_callback=error_callback)
             return [result]
@@ -789,12 +1503,29 @@ class MediaDatabase:
 
         return []
 
-    def __init__(self, paths, path_thumbnails):
+    # NOTE: `generate_thumbnails` makes the indexing workers generate the missing thumbnails from the files they read
+    def __init__(self, paths, thumbnails, metrics=None, generate_thumbnails=False, verify_duplicates=False):
         self.db = {}
-        self.path_thumbnails = path_thumbnails
+        self.columns = MediaColumns()
+        self.thumbnails = thumbnails
+        self.metrics = metrics or Metrics()
+        self.generate_thumbnails = generate_thumbnails
+        self.verify_duplicates = verify_duplicates
+        self.stats = collections.Counter()
+
+        # NOTE: the database is never modified once indexed
+        self.generation = 0
+        self.fragments = FragmentCache(metrics=self.metrics)
 
         self.paths = set((pathlib.Path(path).resolve() for path in paths))
 
+        time_start = time.perf_counter()
+
+        # NOTE: the modules needed to identify the media are loaded before the pool forks its processes, which would
+        # otherwise each load them on their own
+        for module in (ffmpeg, PIL.Image, PIL.ExifTags):
+            getattr(module, "__name__")
+
         with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
             async_results = []
             for path in self.paths:
@@ -805,18 +1536,294 @@ class MediaDatabase:
             for result in async_results:
                 result.wait()
 
+            self._collapse_duplicates(pool)
+
+        duration = time.perf_counter() - time_start
+
+        self.metrics.Observe("index", duration)
+        self.metrics.Set("index_rate", len(self.db) / duration if duration else 0)
+        self.metrics.Set("database_media", len(self.db))
+
+        logging.info("indexed %d media in %.3fs", len(self.db), duration)
+
+    # NOTE: dict values are a view, not a list, which aren't subscriptable
+    def Entries(self):
+        return list(self.db.values())
+
+
+class MediaIndexError(Exception): pass
+
+
+# NOTE: read-only mapping of the hashes to the media of a published index, the entries are the rows of its columns, which
+# are read in place from the mapped file: the pages holding them are shared by all the processes that map it, which
+# only unpickle the few media they render
+class IndexColumns(collections.abc.Mapping):
+    SIZE_HASH = 40
+
+    def __init__(self, view, directory):
+        self.view = view
+        self.sections = directory["sections"]
+        self.count = directory["count"]
+        self.types = directory["types"]
+        self.tag_keys = directory["tag_keys"]
+
+        self.records_offsets = self._section("records_offsets", "q")
+        self.records = self._section("records")
+        self.hashes = self._section("hashes")
+        self.rows_by_hash = self._section("rows_by_hash", "q")
+        self.names_offsets = self._section("names_offsets", "q")
+        self.names = self._section("names")
+        self.filetime_keys = self._section("filetime_keys", "q")
+        self.filetimes = self._section("filetimes", "d")
+        self.types_rows = self._section("types")
+        self.tag_rows = {key: self._section(("tag_rows", key), "q") for key in self.tag_keys}
+
+        if len(self.hashes) != self.count * IndexColumns.SIZE_HASH or len(self.records_offsets) != self.count + 1:
+            raise MediaIndexError("inconsistent index columns")
+
+    def _section(self, name, format=None):
+        offset, length = self.sections[name]
+        if offset + length > len(self.view):
+            raise MediaIndexError("truncated index section: %s" % (name,))
+
+        section = self.view[offset:offset + length]
+
+        return section.cast(format) if format else section
+
+    # NOTE: the hashes are sorted, so that a media is found without building a dict of all of them
+    def _row(self, uuid_media):
+        if not isinstance(uuid_media, str) or len(uuid_media) != IndexColumns.SIZE_HASH:
+            return None
+
+        key = uuid_media.encode("ascii", "replace")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.hashes[middle * IndexColumns.SIZE_HASH:(middle + 1) * IndexColumns.SIZE_HASH].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.count and self.hashes[low * IndexColumns.SIZE_HASH:(low + 1) * IndexColumns.SIZE_HASH] == key:
+            return self.rows_by_hash[low]
+
+        return None
+
+    def _media(self, row):
+        return pickle.loads(self.records[self.records_offsets[row]:self.records_offsets[row + 1]])
+
+    def _name(self, row):
+        return str(self.names[self.names_offsets[row]:self.names_offsets[row + 1]], "utf-8")
+
+    # NOTE: the values of a tag are only unpickled for the duration of the query that needs them
+    def _tag_values(self, key):
+        if key not in self.tag_rows:
+            return {}
+
+        return dict(zip(self.tag_rows[key], pickle.loads(self._section(("tag_values", key)))))
+
+    def __getitem__(self, uuid_media):
+        row = self._row(uuid_media)
+        if row is None:
+            raise KeyError(uuid_media)
+
+        return self._media(row)
+
+    def __contains__(self, uuid_media):
+        return self._row(uuid_media) is not None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield str(self.hashes[i * IndexColumns.SIZE_HASH:(i + 1) * IndexColumns.SIZE_HASH], "ascii")
+
+    def __len__(self):
+        return self.count
+
+    def FilterTag(self, entries, key):
+        rows = set(self.tag_rows.get(key, ()))
+        return [x for x in entries if x in rows]
+
+    def FilterTagValue(self, entries, key, value):
+        values = self._tag_values(key)
+        return [x for x in entries if str(values.get(x, "")) == value]
+
+    def FilterName(self, entries, name):
+        return [x for x in entries if name in self._name(x).lower()]
+
+    def FilterDateKeys(self, entries, key_min, key_max):
+        return [x for x in entries if key_min <= self.filetime_keys[x] <= key_max]
+
+    def FilterType(self, entries, type):
+        if type not in self.types:
+            return []
+
+        code = self.types.index(type)
+        return [x for x in entries if self.types_rows[x] == code]
+
+    def SortTag(self, entries, key, cast, reverse=False):
+        values = self._tag_values(key)
+        return sorted(entries, key=lambda x: cast(values.get(x, "")), reverse=reverse)
+
+    def SortName(self, entries, cast, reverse=False):
+        return sorted(entries, key=lambda x: cast(self._name(x)), reverse=reverse)
+
+    def SortDate(self, entries, reverse=False):
+        return sorted(entries, key=self.filetimes.__getitem__, reverse=reverse)
+
+    def TagSortKeys(self, entries):
+        if len(entries) == self.count:
+            return list(self.tag_keys)
+
+        rows = set(entries)
+        return [key for key in self.tag_keys if any(row in rows for row in self.tag_rows[key])]
+
+    def Media(self, entries):
+        return [self._media(x) for x in entries]
+
+
+# NOTE: read-only view of a media database that was published to a file by another process
+class MediaIndex:
+    MAGIC = b"MSINDEX"
+    # NOTE: the magic, the generation, and the offset of the directory of the sections, which is written last
+    HEADER = struct.Struct("<7sQQ")
+    ALIGNMENT = 8
+
+    @staticmethod
+    def _offsets(blobs):
+        return array.array("q", itertools.accumulate((len(blob) for blob in blobs), initial=0)).tobytes()
+
+    # NOTE: each field is written to its own section, in the order of the rows, the media themselves are pickled
+    # separately so that they're loaded one at a time
+    @staticmethod
+    def _sections(mdb):
+        medias = list(mdb.db.values())
+        types = sorted(set(media.type for media in medias))
+
+        tags = collections.defaultdict(lambda: ([], []))
+        for row, media in enumerate(medias):
+            for key, value in media.tags.items():
+                tags[key][0].append(row)
+                tags[key][1].append(value)
+
+        records = [pickle.dumps(media, protocol=pickle.HIGHEST_PROTOCOL) for media in medias]
+        names = [media.name.encode() for media in medias]
+        rows_by_hash = sorted(range(len(medias)), key=lambda row: medias[row].hash)
+
+        sections = [
+            ("records_offsets", MediaIndex._offsets(records)),
+            ("records", b"".join(records)),
+            ("hashes", b"".join(medias[row].hash.encode("ascii") for row in rows_by_hash)),
+            ("rows_by_hash", array.array("q", rows_by_hash).tobytes()),
+            ("names_offsets", MediaIndex._offsets(names)),
+            ("names", b"".join(names)),
+            ("filetime_keys", array.array("q", (media.filetime_key for media in medias)).tobytes()),
+            ("filetimes", array.array("d", (media.filetime.timestamp() for media in medias)).tobytes()),
+            ("types", bytes(types.index(media.type) for media in medias)),
+        ]
+
+        tag_keys = sorted(tags, key=lambda x: x.lower())
+        for key in tag_keys:
+            rows, values = tags[key]
+            sections.append((("tag_rows", key), array.array("q", rows).tobytes()))
+            sections.append((("tag_values", key), pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)))
+
+        return len(medias), types, tag_keys, sections
+
+    # NOTE: the index is written next to its final path, then moved atomically so that readers never see a partial file
+    @staticmethod
+    def Publish(mdb, path_index, generation):
+        logging.info("publishing index generation %d: %s", generation, path_index)
+
+        path_tmp = path_index.with_name("%s.%d.tmp" % (path_index.name, os.getpid()))
+        try:
+            count, types, tag_keys, sections = MediaIndex._sections(mdb)
+
+            with open(path_tmp, "wb") as fout:
+                fout.write(b"\0" * MediaIndex.HEADER.size)
+
+                # NOTE: the sections are aligned, so that the columns of integers are read without unaligned accesses
+                offsets = {}
+                for name, data in sections:
+                    fout.write(b"\0" * (-fout.tell() % MediaIndex.ALIGNMENT))
+                    offsets[name] = (fout.tell(), len(data))
+                    fout.write(data)
+
+                offset_directory = fout.tell()
+                # NOTE: the metrics of the indexing are published along, so that the workers can expose them
+                pickle.dump({
+                    "count": count,
+                    "types": types,
+                    "tag_keys": tag_keys,
+                    "sections": offsets,
+                    "metrics": mdb.metrics.Snapshot(),
+                }, fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+                fout.seek(0)
+                fout.write(MediaIndex.HEADER.pack(MediaIndex.MAGIC, generation, offset_directory))
+
+                fout.flush()
+                os.fsync(fout.fileno())
+
+            os.replace(path_tmp, path_index)
+        except (OSError, pickle.PicklingError) as e:
+            path_tmp.unlink(missing_ok=True)
+            raise MediaIndexError("unable to publish the index: %s" % e)
+
+    def __init__(self, path_index, thumbnails, metrics=None):
+        self.path_index = path_index
+        self.thumbnails = thumbnails
+        self.generation = None
+        self.fragments = FragmentCache(metrics=metrics)
+
+        # NOTE: the columns of the index are also the mapping of the hashes to the media
+        self.db = None
+        self.columns = None
+        self.metrics = {}
+
+        self.Load()
+
+    # NOTE: the file stays mapped for as long as the columns are referenced, a newer generation replaces it under
+    # another inode, so the mapping remains valid
+    def Load(self):
+        try:
+            with open(self.path_index, "rb") as fin:
+                mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+            magic, generation, offset_directory = MediaIndex.HEADER.unpack_from(mm)
+            if magic != MediaIndex.MAGIC:
+                raise MediaIndexError("invalid index file: %s" % self.path_index)
+
+            view = memoryview(mm)
+            directory = pickle.loads(view[offset_directory:])
+
+            columns = IndexColumns(view, directory)
+            metrics = directory["metrics"]
+        except (OSError, ValueError, KeyError, TypeError, struct.error, pickle.UnpicklingError) as e:
+            raise MediaIndexError("unable to load the index: %s" % e)
+
+        self.db = self.columns = columns
+        self.metrics = metrics
+        self.generation = generation
+
+        logging.info("loaded index generation %d: %d media", self.generation, len(self.db))
+
+    def Entries(self):
+        return range(self.columns.count)
+
 
 class MediaDatabasePlugin(object):
     name = "media_database"
     api = 2
 
-    def __init__(self, images_paths, path_thumbnails, keyword="mdb"):
+    def __init__(self, images_paths, thumbnails, metrics=None, keyword="mdb", mdb=None, generate_thumbnails=False, verify_duplicates=False):
         self.keyword = keyword
+        self.mdb = mdb
 
-        try:
-            self.mdb = MediaDatabase(images_paths, path_thumbnails)
-        except MediaDatabaseError as e:
-            raise bottle.PluginError("Unable to load media database: %s" % e)
+        if self.mdb is None:
+            try:
+                self.mdb = MediaDatabase(images_paths, thumbnails, metrics, generate_thumbnails, verify_duplicates)
+            except MediaDatabaseError as e:
+                raise bottle.PluginError("Unable to load media database: %s" % e)
 
     def setup(self, app):
         for other in app.plugins:
@@ -833,6 +1840,7 @@ class MediaDatabasePlugin(object):
         if self.keyword not in inspect.signature(callback).parameters:
             return callback
 
+        @functools.wraps(callback)
         def wrapper(*args, **kwargs):
             kwargs[keyword] = self.mdb
             return callback(*args, **kwargs)
@@ -840,6 +1848,1137 @@ class MediaDatabasePlugin(object):
         return wrapper
 
 
+# NOTE: video previews are transcoded by a bounded amount of threads, each running one ffmpeg process at a time
+class PreviewTranscoder:
+    # NOTE: previews requested by clients are transcoded before those queued by the background pass
+    PRIORITY_REQUEST = 0
+    PRIORITY_BACKGROUND = 1
+    # NOTE: previews are kept apart from the thumbnails, accounting for their size only lists their own directory
+    DIR_PREVIEWS = "previews"
+    # NOTE: the directory is listed again at this interval, in seconds, to account for the previews of other hosts
+    DELAY_SCAN = 600
+    DELAY_STOP_POLL = 0.1
+
+    # NOTE: `budget` is the maximum size of the previews in the store, in bytes
+    def __init__(self, thumbnails, count_jobs=2, budget=None, metrics=None):
+        self.store = PreviewTranscoder.Store(thumbnails)
+        self.count_jobs = count_jobs
+        self.budget = budget
+        self.metrics = metrics or Metrics()
+
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = {}
+        # NOTE: previews that couldn't be transcoded (e.g. undecodable streams) are not attempted again
+        self.failed = set()
+
+        self.threads = []
+        self.processes = set()
+        self.stopping = False
+
+        # NOTE: size and modification time of the previews in the store, least recently played first
+        self.previews = collections.OrderedDict()
+        self.size_previews = 0
+        self.time_scan = None
+
+    @staticmethod
+    def Store(thumbnails):
+        return ThumbnailStore(thumbnails.path / PreviewTranscoder.DIR_PREVIEWS, timeout=thumbnails.timeout)
+
+    def _scan(self):
+        self.store.RemoveLeftovers()
+
+        previews = sorted(self.store.List(), key=lambda x: x[1].st_mtime)
+
+        with self.lock:
+            self.previews = collections.OrderedDict((name, (st.st_size, st.st_mtime)) for name, st in previews)
+            self.size_previews = sum(size for size, _ in self.previews.values())
+            self.time_scan = time.monotonic()
+
+        self.metrics.Set("preview_bytes", self.size_previews)
+
+    # NOTE: previews transcoded in the background haven't been played yet, they're dated back to be evicted first
+    def _record(self, name, path_preview, played):
+        st = path_preview.stat()
+
+        time_played = st.st_mtime
+        if not played:
+            time_played = 0
+            os.utime(path_preview, (st.st_atime, time_played))
+
+        with self.lock:
+            size, _ = self.previews.pop(name, (0, 0))
+
+            self.previews[name] = (st.st_size, time_played)
+            if not played:
+                self.previews.move_to_end(name, last=False)
+
+            self.size_previews += st.st_size - size
+
+        self.metrics.Set("preview_bytes", self.size_previews)
+
+    # NOTE: the least recently played previews are evicted first, the time they were last played is only checked when
+    # they're about to be evicted, as they're played by other processes, and the given one is kept in any case
+    def _enforce_budget(self, name_kept):
+        if self.budget is None:
+            return
+
+        if self.time_scan is None or time.monotonic() - self.time_scan > PreviewTranscoder.DELAY_SCAN:
+            self._scan()
+
+        with self.lock:
+            while self.size_previews > self.budget and len(self.previews) > 1:
+                name, (size, time_played) = next(iter(self.previews.items()))
+
+                st = self.store.Stat(name)
+                if name == name_kept or (st is not None and st.st_mtime > time_played):
+                    self.previews.move_to_end(name)
+                    if st is not None:
+                        self.previews[name] = (st.st_size, st.st_mtime)
+                    continue
+
+                del self.previews[name]
+                self.size_previews -= size
+
+                if st is not None:
+                    logging.info("evicting preview: %s", name)
+
+                    self.store.Remove(name)
+                    self.metrics.Increment("preview_evictions")
+
+        self.metrics.Set("preview_bytes", self.size_previews)
+
+    def _transcode(self, media, breakpoint, priority):
+        name = media.PreviewName(breakpoint)
+        if self.store.Contains(name):
+            return
+
+        # NOTE: the background pass only fills the budget, so that it never evicts the previews that were played
+        if priority == PreviewTranscoder.PRIORITY_BACKGROUND and self.budget is not None and self.size_previews >= self.budget:
+            logging.debug("preview budget exhausted, skipping: %s", name)
+            return
+
+        try:
+            with self.metrics.Timer("preview_transcoding", breakpoint=breakpoint):
+                path_preview = self.store.Generate(name, lambda path: not self.stopping and media.CreatePreview(breakpoint, path, self.processes))
+        except ThumbnailStoreError as e:
+            logging.warning("unable to transcode preview: %s", e)
+            return
+
+        if path_preview is None:
+            if self.stopping:
+                return
+
+            self.metrics.Increment("preview_failures", breakpoint=breakpoint)
+
+            with self.lock:
+                self.failed.add(name)
+            return
+
+        self.metrics.Increment("preview_transcoded", breakpoint=breakpoint)
+
+        self._record(name, path_preview, priority == PreviewTranscoder.PRIORITY_REQUEST)
+        if priority == PreviewTranscoder.PRIORITY_REQUEST:
+            self._enforce_budget(name)
+
+    def _run(self):
+        while True:
+            priority, _, media, breakpoint = self.queue.get()
+            if media is None:
+                return
+
+            try:
+                self._transcode(media, breakpoint, priority)
+            except Exception as e:
+                logging.error("unable to transcode preview: %s", e)
+            finally:
+                with self.lock:
+                    self.pending.pop(media.PreviewName(breakpoint), None)
+
+    def Enabled(self):
+        return self.count_jobs > 0
+
+    def Start(self):
+        # NOTE: lazily imported modules aren't safe to load from several threads at once
+        getattr(ffmpeg, "__name__")
+
+        for i in range(self.count_jobs):
+            thread = threading.Thread(target=self._run, name="preview-%d" % i, daemon=True)
+            thread.start()
+
+            self.threads.append(thread)
+
+    # NOTE: the running ffmpeg processes are killed, so that no temporary file or lock is left behind in the store
+    def Stop(self):
+        self.stopping = True
+
+        for _ in self.threads:
+            self.queue.put((-1, next(self.sequence), None, None))
+
+        # NOTE: processes started while the others are being killed are caught by the following iterations
+        processes_killed = set()
+        for thread in self.threads:
+            while thread.is_alive():
+                for process in self.processes - processes_killed:
+                    process.kill()
+                    processes_killed.add(process)
+
+                thread.join(PreviewTranscoder.DELAY_STOP_POLL)
+
+    # NOTE: a preview already queued is queued again only if it's now more urgent
+    def Submit(self, media, breakpoint, priority=PRIORITY_REQUEST):
+        if not self.Enabled():
+            return
+
+        name = media.PreviewName(breakpoint)
+        with self.lock:
+            if name in self.failed or self.pending.get(name, math.inf) <= priority:
+                return
+
+            self.pending[name] = priority
+
+        self.queue.put((priority, next(self.sequence), media, breakpoint))
+
+    # NOTE: queues the previews missing from the store
+    def SubmitAll(self, medias):
+        self._scan()
+
+        for media in medias:
+            if media.type != "video":
+                continue
+
+            for breakpoint in Media.BREAKPOINTS:
+                if not self.store.Contains(media.PreviewName(breakpoint)):
+                    self.Submit(media, breakpoint, PreviewTranscoder.PRIORITY_BACKGROUND)
+
+    def Lookup(self, name):
+        return self.store.Lookup(name)
+
+    # NOTE: the modification time of the previews tells when they were last played
+    def Touch(self, name):
+        self.store.Touch(name)
+
+
+# NOTE: used by the workers, which forward the previews requested to the single process that transcodes them
+class PreviewClient:
+    def __init__(self, thumbnails, requests):
+        self.store = PreviewTranscoder.Store(thumbnails)
+        self.requests = requests
+
+    def Enabled(self):
+        return True
+
+    def Submit(self, media, breakpoint):
+        try:
+            self.requests.put_nowait((media.hash, breakpoint))
+        except queue.Full:
+            logging.debug("too many previews requested, dropping: %s", media.PreviewName(breakpoint))
+
+    def Lookup(self, name):
+        return self.store.Lookup(name)
+
+    def Touch(self, name):
+        self.store.Touch(name)
+
+
+class PreviewPlugin(object):
+    name = "previews"
+    api = 2
+
+    def __init__(self, previews, keyword="previews"):
+        self.keyword = keyword
+        self.previews = previews
+
+    def setup(self, app):
+        for other in app.plugins:
+            if not isinstance(other, PreviewPlugin):
+                continue
+
+            if other.keyword == self.keyword:
+                raise bottle.PluginError("Found another '%s' plugin with conflicting settings (non-unique keyword)." % self.name)
+
+    def apply(self, callback, context):
+        conf = context.config.get(PreviewPlugin.name) or {}
+        keyword = conf.get("keyword", self.keyword)
+
+        if self.keyword not in inspect.signature(callback).parameters:
+            return callback
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            kwargs[keyword] = self.previews
+            return callback(*args, **kwargs)
+
+        return wrapper
+
+
+class Metrics:
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    PREFIX = "mediasurf"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # NOTE: all maps are keyed by `(name, labels)`, where the labels are a sorted tuple of pairs
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        # NOTE: timers hold a `[count, sum]` pair, the sum being in seconds
+        self.timers = collections.defaultdict(lambda: [0, 0.0])
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+
+        def escape(s):
+            return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        return "{%s}" % ",".join("%s=\"%s\"" % (k, escape(v)) for k, v in labels)
+
+    def Increment(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[Metrics._key(name, labels)] += value
+
+    def Set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[Metrics._key(name, labels)] = value
+
+    def Observe(self, name, duration, **labels):
+        with self.lock:
+            timer = self.timers[Metrics._key(name, labels)]
+            timer[0] += 1
+            timer[1] += duration
+
+    # NOTE: a picklable copy of the metrics, to be merged into the metrics of another process
+    def Snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timers": {k: tuple(v) for k, v in self.timers.items()},
+            }
+
+    def Merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot.get("counters", {}).items():
+                self.counters[key] += value
+
+            self.gauges.update(snapshot.get("gauges", {}))
+
+            for key, (count, total) in snapshot.get("timers", {}).items():
+                timer = self.timers[key]
+                timer[0] += count
+                timer[1] += total
+
+    @contextlib.contextmanager
+    def Timer(self, name, timings=None, **labels):
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - time_start
+
+            self.Observe(name, duration, **labels)
+
+            if timings is not None:
+                timings[name] = timings.get(name, 0) + duration
+
+    # NOTE: the output follows the Prometheus text exposition format
+    def Render(self):
+        def group(entries):
+            groups = collections.OrderedDict()
+            for (name, labels), value in sorted(entries.items()):
+                groups.setdefault(name, []).append((labels, value))
+            return groups.items()
+
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            timers = {k: tuple(v) for k, v in self.timers.items()}
+
+        lines = []
+        for name, series in group(counters):
+            metric = "%s_%s_total" % (Metrics.PREFIX, name)
+            lines.append("# TYPE %s counter" % metric)
+            for labels, value in series:
+                lines.append("%s%s %s" % (metric, Metrics._format_labels(labels), value))
+
+        for name, series in group(gauges):
+            metric = "%s_%s" % (Metrics.PREFIX, name)
+            lines.append("# TYPE %s gauge" % metric)
+            for labels, value in series:
+                lines.append("%s%s %s" % (metric, Metrics._format_labels(labels), value))
+
+        for name, series in group(timers):
+            metric = "%s_%s_seconds" % (Metrics.PREFIX, name)
+            lines.append("# TYPE %s summary" % metric)
+            for labels, (count, total) in series:
+                lines.append("%s_count%s %d" % (metric, Metrics._format_labels(labels), count))
+                lines.append("%s_sum%s %f" % (metric, Metrics._format_labels(labels), total))
+
+        return "\n".join(lines) + "\n"
+
+
+# NOTE: the metrics of each process are written to their own file of a directory shared by all of them, which are merged
+# when rendered, so that counters keep increasing whichever process serves the request
+class SharedMetrics(Metrics):
+    # NOTE: interval at which the metrics are written, in seconds
+    DELAY_FLUSH = 5
+
+    # NOTE: `snapshot` holds metrics common to all the processes (e.g. those of the indexing), which are only exposed once
+    def __init__(self, path, name, snapshot=None):
+        super().__init__()
+
+        self.path = path
+        self.name = name
+        self.snapshot = snapshot or {}
+
+    def _run(self):
+        while True:
+            time.sleep(SharedMetrics.DELAY_FLUSH)
+            self.Flush()
+
+    def Start(self):
+        threading.Thread(target=self._run, name="metrics", daemon=True).start()
+
+    def Flush(self):
+        path_snapshot = self.path / ("%s.pickle" % self.name)
+        path_tmp = path_snapshot.with_name(".%s.tmp" % path_snapshot.name)
+
+        try:
+            with open(path_tmp, "wb") as fout:
+                pickle.dump(self.Snapshot(), fout, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(path_tmp, path_snapshot)
+        except OSError as e:
+            logging.warning("unable to write metrics: %s", e)
+
+    def Render(self):
+        self.Flush()
+
+        metrics = Metrics()
+        metrics.Merge(self.snapshot)
+
+        for path in sorted(self.path.glob("*.pickle")):
+            try:
+                with open(path, "rb") as fin:
+                    metrics.Merge(pickle.load(fin))
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logging.warning("unable to read metrics: %s", e)
+
+        return metrics.Render()
+
+
+class MetricsPlugin(object):
+    name = "metrics"
+    api = 2
+
+    ENVIRON_KEY = "mediasurf.server_timings"
+
+    def __init__(self, metrics=None, keyword="metrics"):
+        self.keyword = keyword
+        self.metrics = metrics or Metrics()
+
+    def setup(self, app):
+        for other in app.plugins:
+            if not isinstance(other, MetricsPlugin):
+                continue
+
+            if other.keyword == self.keyword:
+                raise bottle.PluginError("Found another '%s' plugin with conflicting settings (non-unique keyword)." % self.name)
+
+    def apply(self, callback, context):
+        conf = context.config.get(MetricsPlugin.name) or {}
+        keyword = conf.get("keyword", self.keyword)
+        inject = self.keyword in inspect.signature(callback).parameters
+        route = context.name or context.rule
+
+        # NOTE: all routes are wrapped to account for requests, but only those that ask for it get the metrics
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            if inject:
+                kwargs[keyword] = self.metrics
+
+            timings = server_timings()
+
+            with self.metrics.Timer("request", timings=timings, route=route):
+                body = callback(*args, **kwargs)
+
+            # NOTE: `static_file` returns a response object whose headers override the global ones
+            r = body if isinstance(body, bottle.HTTPResponse) else response
+            r.set_header("Server-Timing", ", ".join("%s;dur=%.3f" % (k, v * 1000) for k, v in timings.items()))
+
+            return body
+
+        return wrapper
+
+
+# NOTE: HTML and JSON bodies returned by the routes are compressed with the encoding the client prefers
+class CompressionPlugin(object):
+    name = "compression"
+    api = 2
+
+    CONTENT_TYPES = ["text/html", "application/json"]
+    # NOTE: smaller bodies fit in a single packet anyway
+    SIZE_MIN = 1024
+    LEVEL_GZIP = 6
+    QUALITY_BROTLI = 5
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics or Metrics()
+
+        # NOTE: the order breaks ties between encodings the client accepts equally
+        self.encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+    def setup(self, app):
+        for other in app.plugins:
+            if isinstance(other, CompressionPlugin) and other is not self:
+                raise bottle.PluginError("Found another '%s' plugin." % self.name)
+
+    @staticmethod
+    def _negotiate(accept_encoding, encodings):
+        qualities = {}
+        for item in accept_encoding.split(","):
+            name, _, params = item.partition(";")
+
+            quality = 1.0
+            for param in params.split(";"):
+                k, _, v = param.strip().partition("=")
+                if k == "q":
+                    quality = str2float(v) or 0.0
+
+            qualities[name.strip().lower()] = quality
+
+        encoding_best, quality_best = None, 0.0
+        for encoding in encodings:
+            quality = qualities.get(encoding, qualities.get("*", 0.0))
+            if quality > quality_best:
+                encoding_best, quality_best = encoding, quality
+
+        return encoding_best
+
+    def _compress(self, body, encoding):
+        if encoding == "br":
+            return brotli.compress(body, quality=CompressionPlugin.QUALITY_BROTLI)
+
+        return gzip.compress(body, compresslevel=CompressionPlugin.LEVEL_GZIP)
+
+    def apply(self, callback, context):
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            body = callback(*args, **kwargs)
+
+            # NOTE: the JSON plugin is applied after this one, responses objects (e.g. static files) are left alone
+            if isinstance(body, dict):
+                body = bottle.json_dumps(body)
+                response.content_type = "application/json"
+            elif not isinstance(body, (str, bytes)):
+                return body
+
+            content_type = (response.content_type or response.default_content_type).split(";")[0].strip()
+            if content_type not in CompressionPlugin.CONTENT_TYPES:
+                return body
+
+            response.add_header("Vary", "Accept-Encoding")
+
+            if isinstance(body, str):
+                body = body.encode(response.charset or "utf8")
+
+            encoding = CompressionPlugin._negotiate(request.headers.get("Accept-Encoding", ""), self.encodings)
+            if encoding is None or len(body) < CompressionPlugin.SIZE_MIN:
+                return body
+
+            with self.metrics.Timer("compression", timings=server_timings(), encoding=encoding):
+                body_compressed = self._compress(body, encoding)
+
+            self.metrics.Increment("compression_bytes_in", len(body), encoding=encoding)
+            self.metrics.Increment("compression_bytes_out", len(body_compressed), encoding=encoding)
+
+            response.set_header("Content-Encoding", encoding)
+
+            return body_compressed
+
+        return wrapper
+
+
+# NOTE: serves requests on a socket that was bound and is listened on by the parent process
+class InheritedSocketServer(bottle.ServerAdapter):
+    def run(self, handler):
+        from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(*args, **kw):
+                pass
+
+        sock = self.options["sock"]
+
+        server = WSGIServer(sock.getsockname()[:2], QuietHandler if self.quiet else WSGIRequestHandler,
+                            bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+
+        host, port = sock.getsockname()[:2]
+        server.server_name = socket.getfqdn(host)
+        server.server_port = port
+        server.setup_environ()
+        server.set_app(handler)
+
+        # NOTE: the worker is retired on SIGHUP once the request being handled is done, `shutdown` waits for the serving
+        # loop to exit so it can't be called from the signal handler, which runs in the same thread
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start())
+
+        server.serve_forever()
+
+
+class PreforkError(Exception): pass
+
+
+class PreforkCoordinator:
+    SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGINT, signal.SIGTERM}
+    # NOTE: workers that fail faster than this are not restarted, to avoid restarting them in a loop
+    DELAY_WORKER_FAILURE = 1
+    DELAY_POLL = 1
+    # NOTE: previews requested while that many are waiting to be transcoded are dropped, they're requested again when played
+    SIZE_PREVIEW_REQUESTS = 1024
+
+    def __init__(self, count_workers, sock, paths, path_index, thumbnails, generate_thumbnails=False, verify_duplicates=False,
+                 count_preview_jobs=0, preview_budget=None, debug=False):
+        self.count_workers = count_workers
+        self.sock = sock
+        self.paths = paths
+        self.path_index = path_index
+        self.thumbnails = thumbnails
+        self.generate_thumbnails = generate_thumbnails
+        self.verify_duplicates = verify_duplicates
+        self.count_preview_jobs = count_preview_jobs
+        self.preview_budget = preview_budget
+        self.debug = debug
+
+        self.generation = 0
+        self.pid_indexer = None
+        self.rescan_pending = False
+        self.pids_workers = {}
+        self.pids_retired = set()
+        # NOTE: previews are transcoded by a single process, so that the amount of ffmpeg processes stays bounded
+        self.pid_transcoder = None
+        self.time_transcoder = None
+        self.requests_previews = None
+        # NOTE: each process started writes its metrics to its own file, whose name is never re-used
+        self.path_metrics = path_index.with_name("metrics")
+        self.sequence = itertools.count()
+
+        self.mdb = None
+
+    def _fork(self, f):
+        pid = os.fork()
+        if pid:
+            return pid
+
+        code = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, PreforkCoordinator.SIGNALS)
+
+            code = f() or 0
+        except Exception:
+            logging.exception("unexpected error in child process")
+        finally:
+            os._exit(code)
+
+    def _index(self):
+        try:
+            mdb = MediaDatabase(self.paths, self.thumbnails,
+                                generate_thumbnails=self.generate_thumbnails, verify_duplicates=self.verify_duplicates)
+            MediaIndex.Publish(mdb, self.path_index, self.generation)
+        except (MediaDatabaseError, MediaIndexError) as e:
+            logging.error("unable to build the index: %s", e)
+            return 1
+
+    # NOTE: the index is mapped once by the coordinator, then shared with the workers it forks, which read its columns
+    # in place rather than holding a copy of the media in their own memory
+    def _load(self):
+        try:
+            self.mdb = MediaIndex(self.path_index, self.thumbnails)
+        except MediaIndexError as e:
+            if self.mdb is None:
+                raise PreforkError("unable to load the initial index: %s" % e)
+
+            logging.error("keeping index generation %d: %s", self.mdb.generation, e)
+            return False
+
+        return True
+
+    def _serve(self, name):
+        # NOTE: interruptions are handled by the coordinator, which terminates the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        metrics = SharedMetrics(self.path_metrics, name, self.mdb.metrics)
+        metrics.Start()
+
+        self.mdb.fragments = FragmentCache(metrics=metrics)
+
+        bottle.install(MetricsPlugin(metrics))
+        bottle.install(CompressionPlugin(metrics))
+        bottle.install(MediaDatabasePlugin(None, self.thumbnails, metrics, mdb=self.mdb))
+
+        if self.requests_previews is not None:
+            bottle.install(PreviewPlugin(PreviewClient(self.thumbnails, self.requests_previews)))
+        else:
+            bottle.install(PreviewPlugin(PreviewTranscoder(self.thumbnails, 0)))
+
+        bottle.run(server=InheritedSocketServer(sock=self.sock), quiet=True, debug=self.debug)
+
+        metrics.Flush()
+
+    def _transcode(self, name):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # NOTE: the transcoder is retired like the workers, and terminated by the coordinator, in both cases it waits for
+        # the ffmpeg processes it terminates
+        stopping = threading.Event()
+        for signum in [signal.SIGHUP, signal.SIGTERM]:
+            signal.signal(signum, lambda signum, frame: stopping.set())
+
+        metrics = SharedMetrics(self.path_metrics, name)
+        metrics.Start()
+
+        previews = PreviewTranscoder(self.thumbnails, self.count_preview_jobs, self.preview_budget, metrics)
+        previews.Start()
+        previews.SubmitAll(self.mdb.columns.Media(self.mdb.columns.FilterType(self.mdb.Entries(), "video")))
+
+        while not stopping.is_set():
+            try:
+                uuid_media, breakpoint = self.requests_previews.get(timeout=PreforkCoordinator.DELAY_POLL)
+            except queue.Empty:
+                continue
+
+            media = self.mdb.db.get(uuid_media)
+            if media is not None and media.type == "video":
+                previews.Submit(media, breakpoint)
+
+        previews.Stop()
+        metrics.Flush()
+
+    def _start_transcoder(self):
+        if self.requests_previews is None or self.pid_transcoder is not None:
+            return
+
+        self.pid_transcoder = self._fork(functools.partial(self._transcode, "transcoder-%d" % next(self.sequence)))
+        self.time_transcoder = time.monotonic()
+
+        logging.info("started transcoder, pid %d", self.pid_transcoder)
+
+    def _start_indexer(self):
+        self.generation += 1
+        self.rescan_pending = False
+        self.pid_indexer = self._fork(self._index)
+
+        logging.info("indexing generation %d, pid %d", self.generation, self.pid_indexer)
+
+    def _start_workers(self):
+        while len(self.pids_workers) < self.count_workers:
+            pid = self._fork(functools.partial(self._serve, "worker-%d" % next(self.sequence)))
+            self.pids_workers[pid] = time.monotonic()
+
+            logging.info("started worker, pid %d", pid)
+
+    # NOTE: the workers serving the previous generation are asked to exit, the new ones accept the requests meanwhile
+    def _retire_workers(self):
+        for pid in self.pids_workers:
+            logging.info("retiring worker, pid %d", pid)
+
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+        self.pids_retired.update(self.pids_workers)
+        self.pids_workers.clear()
+
+        if self.pid_transcoder is not None:
+            logging.info("retiring transcoder, pid %d", self.pid_transcoder)
+
+            try:
+                os.kill(self.pid_transcoder, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+            self.pids_retired.add(self.pid_transcoder)
+            self.pid_transcoder = None
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if not pid:
+                return
+
+            code = os.waitstatus_to_exitcode(status)
+
+            if pid == self.pid_indexer:
+                self.pid_indexer = None
+
+                if code:
+                    logging.error("indexer exited with code %d", code)
+                    self.generation -= 1
+
+                    if not self.pids_workers:
+                        raise PreforkError("unable to build the initial index")
+                elif self._load():
+                    self._retire_workers()
+                    self._start_workers()
+                    self._start_transcoder()
+
+                if self.rescan_pending:
+                    self._start_indexer()
+            elif pid in self.pids_retired:
+                self.pids_retired.discard(pid)
+
+                logging.info("retired process %d exited with code %d", pid, code)
+            elif pid == self.pid_transcoder:
+                self.pid_transcoder = None
+
+                if code and time.monotonic() - self.time_transcoder < PreforkCoordinator.DELAY_WORKER_FAILURE:
+                    raise PreforkError("transcoder %d failed on startup with code %d" % (pid, code))
+
+                logging.warning("transcoder %d exited with code %d, restarting it", pid, code)
+
+                self._start_transcoder()
+            elif pid in self.pids_workers:
+                time_started = self.pids_workers.pop(pid)
+
+                if code and time.monotonic() - time_started < PreforkCoordinator.DELAY_WORKER_FAILURE:
+                    raise PreforkError("worker %d failed on startup with code %d" % (pid, code))
+
+                logging.warning("worker %d exited with code %d, restarting it", pid, code)
+
+                self._start_workers()
+
+    def _stop(self):
+        pids = (set(self.pids_workers) | self.pids_retired | {self.pid_indexer, self.pid_transcoder}) - {None}
+
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def Run(self):
+        # NOTE: signals are only received synchronously, the children unblock them after they are forked
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.pthread_sigmask(signal.SIG_BLOCK, PreforkCoordinator.SIGNALS)
+
+        # NOTE: the metrics of a previous run are discarded, counters start over as they would with a single process
+        try:
+            shutil.rmtree(self.path_metrics, ignore_errors=True)
+            self.path_metrics.mkdir(parents=True)
+        except OSError as e:
+            logging.critical("unable to create the metrics directory: %s", e)
+            return 1
+
+        # NOTE: the queue is created before any process is forked, so that they all share it
+        if self.count_preview_jobs > 0:
+            self.requests_previews = multiprocessing.Queue(PreforkCoordinator.SIZE_PREVIEW_REQUESTS)
+
+        self._start_indexer()
+
+        try:
+            while True:
+                signum = signal.sigwait(PreforkCoordinator.SIGNALS)
+
+                if signum == signal.SIGCHLD:
+                    self._reap()
+                elif signum == signal.SIGHUP:
+                    logging.info("rescanning the media")
+
+                    if self.pid_indexer is None:
+                        self._start_indexer()
+                    else:
+                        self.rescan_pending = True
+                else:
+                    logging.info("stopping")
+                    return 0
+        except PreforkError as e:
+            logging.critical("%s", e)
+            return 1
+        finally:
+            self._stop()
+
+
+class ExportError(Exception): pass
+
+
+class GalleryExporter:
+    BREAKPOINTS = Media.BREAKPOINTS
+
+    NAME_INDEX = "index.json"
+    NAME_TEMPLATE = "index.mako"
+    DIR_CARDS = "cards"
+    DIR_MEDIA = "media"
+    DIR_STATIC = "static"
+
+    FIELDS_INDEX = ["hash", "name", "type", "date", "time", "tags"]
+
+    def __init__(self, mdb, path_export, path_ui, limit=25, path_templates=None):
+        self.mdb = mdb
+        self.path_export = path_export
+        self.path_ui = path_ui
+        self.limit = limit
+
+        self.stats = collections.Counter()
+
+        self.router = router_t(
+            get_url=self._get_url,
+            current_route_name="index",
+            current_url=self._page_name(1),
+        )
+
+        # NOTE: the templates are otherwise only rendered through bottle, which imports mako on its own
+        import mako.lookup
+
+        lookup = mako.lookup.TemplateLookup(directories=[str(self.path_ui / "templates")],
+                                            module_directory=str(path_templates) if path_templates else None)
+        self.template = lookup.get_template(GalleryExporter.NAME_TEMPLATE)
+
+    # NOTE: the URLs are made relative, so that the gallery can be hosted under any prefix
+    @staticmethod
+    def _get_url(routename, **kwargs):
+        url = bottle.app().get_url(routename, **kwargs)
+
+        if url == "/":
+            return GalleryExporter._page_name(1)
+
+        return url.lstrip("/")
+
+    @staticmethod
+    def _page_name(page):
+        return "index.html" if page == 1 else "page-%d.html" % page
+
+    def _url_for(self, page=None, limit=None):
+        # NOTE: pages with a custom limit are rendered by the browser, from the index
+        if limit is not None:
+            return "%s?%s" % (GalleryExporter._page_name(1), urllib.parse.urlencode({"limit": limit, "page": page or 1}))
+
+        return GalleryExporter._page_name(page)
+
+    @staticmethod
+    def _is_same_file(path_source, path_destination):
+        try:
+            st_source = path_source.stat()
+            st_destination = path_destination.stat()
+        except FileNotFoundError:
+            return False
+
+        return (st_source.st_dev, st_source.st_ino) == (st_destination.st_dev, st_destination.st_ino) \
+               or (st_source.st_size, st_source.st_mtime_ns) == (st_destination.st_size, st_destination.st_mtime_ns)
+
+    # NOTE: files are hard-linked when possible, copied otherwise, and moved into place atomically
+    @staticmethod
+    def _link(path_source, path_destination, hardlink=True):
+        if GalleryExporter._is_same_file(path_source, path_destination):
+            return False
+
+        path_destination.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path_destination.with_name(".%s.tmp" % path_destination.name)
+
+        if hardlink:
+            try:
+                os.link(path_source, path_tmp)
+            except OSError:
+                hardlink = False
+
+        if not hardlink:
+            shutil.copy2(path_source, path_tmp)
+
+        os.replace(path_tmp, path_destination)
+
+        return True
+
+    def _write(self, path, content, name_stat):
+        content = content.encode()
+
+        try:
+            if path.read_bytes() == content:
+                self.stats["%s_unchanged" % name_stat] += 1
+                return
+        except FileNotFoundError:
+            pass
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_name(".%s.tmp" % path.name)
+        path_tmp.write_bytes(content)
+        os.replace(path_tmp, path)
+
+        self.stats["%s_written" % name_stat] += 1
+
+    # NOTE: The function cannot be a member function because of multi-processing
+    @staticmethod
+    def _export_media(args):
+        media, thumbnails, path_media, url_media, urls_thumbnail = args
+
+        stats = collections.Counter()
+
+        try:
+            # NOTE: linking the original would change its creation time, which is the date of the media
+            if GalleryExporter._link(media.path, path_media / url_media, hardlink=False):
+                stats["originals_written"] += 1
+            else:
+                stats["originals_unchanged"] += 1
+
+            for breakpoint, url_thumbnail in urls_thumbnail:
+                name_thumbnail = media.ThumbnailName(breakpoint)
+
+                path_thumbnail = thumbnails.Lookup(name_thumbnail)
+                if path_thumbnail is None:
+                    try:
+                        path_thumbnail = thumbnails.Generate(name_thumbnail,
+                                                             lambda path: media.CreateThumbnail(breakpoint, path))
+                    except ThumbnailStoreError as e:
+                        logging.error("unable to export thumbnail: %s", e)
+
+                    if path_thumbnail is None:
+                        stats["thumbnails_failed"] += 1
+                        continue
+
+                    stats["thumbnails_generated"] += 1
+
+                if GalleryExporter._link(path_thumbnail, path_media / url_thumbnail):
+                    stats["thumbnails_written"] += 1
+                else:
+                    stats["thumbnails_unchanged"] += 1
+        except OSError as e:
+            logging.error("unable to export media %s: %s", media.path, e)
+            stats["media_failed"] += 1
+
+        return stats
+
+    def _export_static(self):
+        path_static = self.path_ui / "static"
+
+        for path in path_static.rglob("*"):
+            if path.is_file():
+                if GalleryExporter._link(path, self.path_export / GalleryExporter.DIR_STATIC / path.relative_to(path_static)):
+                    self.stats["static_written"] += 1
+                else:
+                    self.stats["static_unchanged"] += 1
+
+    def _export_medias(self, all_entries):
+        tasks = []
+        for media in all_entries:
+            url_media = self._get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)
+            urls_thumbnail = [(breakpoint, self._get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint=breakpoint, extension=Media.FORMAT_THUMBNAIL))
+                              for breakpoint in GalleryExporter.BREAKPOINTS]
+
+            tasks.append((media, self.mdb.thumbnails, self.path_export, url_media, urls_thumbnail))
+
+        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
+            for stats in pool.imap_unordered(GalleryExporter._export_media, tasks, chunksize=8):
+                self.stats.update(stats)
+
+    def _export_pages(self, all_entries):
+        tag_sort_keys = self.mdb.columns.TagSortKeys(all_entries)
+        # NOTE: cards are rendered once, for the pages and their own files
+        fragment = functools.partial(FragmentCache().Get, 0)
+        count_pages = max(1, math.ceil(len(all_entries) / self.limit))
+
+        for i in range(1, count_pages + 1):
+            request = bottle.BaseRequest({
+                "PATH_INFO": "/",
+                "QUERY_STRING": urllib.parse.urlencode({"page": i, "limit": self.limit}),
+            })
+            page = Page(all_entries, request, url_for=self._url_for, tag_sort_keys=tag_sort_keys)
+
+            self._write(self.path_export / GalleryExporter._page_name(i),
+                        self.template.render(router=self.router, page=page, fragment=fragment, static_export=True,
+                                             video_previews=False),
+                        "pages")
+
+        template_card = self.template.get_def("card")
+        for media in all_entries:
+            self._write(self.path_export / GalleryExporter.DIR_CARDS / ("%s.html" % media.hash),
+                        fragment(("card", media.hash), lambda: template_card.render(router=self.router, media=media, static_export=True,
+                                                                                     video_previews=False)),
+                        "cards")
+
+        return count_pages
+
+    def _export_index(self, all_entries):
+        index = {
+            "fields": GalleryExporter.FIELDS_INDEX,
+            "media": [[
+                media.hash,
+                media.name,
+                media.type,
+                media.filetime_key,
+                media.filetime.timestamp(),
+                {str(k): str(v) for k, v in media.tags.items()},
+            ] for media in all_entries],
+        }
+
+        self._write(self.path_export / GalleryExporter.NAME_INDEX,
+                    json.dumps(index, separators=(",", ":")),
+                    "index")
+
+    # NOTE: removes the files of media that are not in the database anymore, and the pages past the last one
+    def _prune(self, all_entries, count_pages):
+        hashes = set(media.hash for media in all_entries)
+
+        def remove(path):
+            logging.debug("removing stale file: %s", path)
+
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+
+            self.stats["removed"] += 1
+
+        for path in itertools.chain((self.path_export / GalleryExporter.DIR_MEDIA).glob("*"),
+                                    (self.path_export / GalleryExporter.DIR_CARDS).glob("*")):
+            if path.name.split(".")[0] not in hashes:
+                remove(path)
+
+        for path in self.path_export.glob("page-*.html"):
+            if str2int(path.stem[len("page-"):]) is None or str2int(path.stem[len("page-"):]) > count_pages:
+                remove(path)
+
+    def Run(self):
+        logging.info("exporting gallery: %s", self.path_export)
+
+        try:
+            self.path_export.mkdir(parents=True, exist_ok=True)
+
+            # NOTE: the default order is the most recent media first
+            all_entries = sorted(self.mdb.db.values(), key=lambda x: x.name)
+            all_entries = sorted(all_entries, key=lambda x: x.filetime, reverse=True)
+
+            self._export_static()
+            self._export_medias(all_entries)
+            count_pages = self._export_pages(all_entries)
+            self._export_index(all_entries)
+            self._prune(all_entries, count_pages)
+        except OSError as e:
+            raise ExportError("unable to export the gallery: %s" % e)
+
+        logging.info("export statistics: %s", ", ".join("%s=%d" % i for i in sorted(self.stats.items())))
+
+        return self.stats
+
+
 class Defaults:
     PROGRAM_NAME = "mediasurf"
     PROGRAM_DESCRIPTION = "MediaSurf media gallery"
@@ -858,6 +2997,10 @@ class Defaults:
 
     USER_INTERFACE = "bootstrap5"
 
+    # NOTE: previews are opt-in, transcoding every video is costly
+    PREVIEW_JOBS = 0
+    PREVIEW_BUDGET = 1024
+
 
 class CliOptions(argparse.Namespace):
     def __init__(self, args):
@@ -869,13 +3012,63 @@ class CliOptions(argparse.Namespace):
         parser.add_argument("-U", "--user-interface", default=Defaults.USER_INTERFACE, help="Name of the user interface to use")
         # TODO: embed in script, remove option
         parser.add_argument("-D", "--data-dir", default=Defaults.DIR_DATA, help="Path to the directory that holds the data files (e.g. user interfaces)")
+        parser.add_argument("-w", "--workers", type=int, default=0, help="Amount of worker processes to serve requests with, sharing a single index (0 serves from a single process)")
+        parser.add_argument("-X", "--export", help="Path to the directory to export a static gallery to, instead of serving it")
         parser.add_argument("-E", "--ephemerals", default=Defaults.DIR_EPHEMERALS, help="Path to the directory that holds ephemeral files (e.g. thumbnails)")
+        parser.add_argument("-T", "--thumbnails-store", help="Path to a directory that holds thumbnails shared with other instances (e.g. on a network filesystem)")
+        parser.add_argument("-L", "--local-thumbnails", action="store_true", help="Keep a copy of the thumbnails of the shared store in the ephemerals directory")
+        parser.add_argument("-G", "--generate-thumbnails", action="store_true", help="Generate the missing thumbnails of the media while indexing them, instead of on first request")
+        parser.add_argument("-V", "--verify-duplicates", action="store_true", help="Read the whole content of the media that look identical, to make sure they are duplicates before they share thumbnails")
+        parser.add_argument("-j", "--preview-jobs", type=int, default=Defaults.PREVIEW_JOBS, help="Amount of video previews transcoded concurrently, to play videos from low-bitrate previews instead of the originals (disabled by default)")
+        parser.add_argument("-B", "--preview-budget", type=int, default=Defaults.PREVIEW_BUDGET, help="Maximum size of the video previews kept in the thumbnail store, in MiB")
+        parser.add_argument("--profile-startup", action="store_true", help="Report the time spent importing dependencies, scanning the media and rendering the first page, then exit")
         parser.add_argument("paths", metavar="path", nargs="+", help="Path to the pictures or directories to share")
 
         parser.parse_args(args, self)
 
 
+def templates_key(path_templates):
+    h = hashlib.sha1(str(path_templates.resolve()).encode())
+
+    for path in sorted(path_templates.glob("*.mako")):
+        h.update(path.name.encode())
+        try:
+            h.update(path.read_bytes())
+        except OSError as e:
+            logging.warning("unable to read template: %s", e)
+
+    return h.hexdigest()
+
+
+# NOTE: the first page is requested through the application, the same way a server would
+def profile_startup(time_main_start, time_scan_start, time_scan_end):
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+
+    statuses = []
+    body = b"".join(bottle.app()(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+
+    time_render_end = time.perf_counter()
+
+    durations = collections.OrderedDict([
+        ("import", time_main_start - TIME_IMPORT_START),
+        ("scan", time_scan_end - time_scan_start),
+        ("first render", time_render_end - time_scan_end),
+    ])
+    for name, duration in environ.get(MetricsPlugin.ENVIRON_KEY, {}).items():
+        durations["  %s" % name] = duration
+    durations["total"] = time_render_end - TIME_IMPORT_START
+
+    print("startup profile (first page: %s, %d bytes)" % (statuses[0] if statuses else "-", len(body)))
+    for name, duration in durations.items():
+        print("%-20s %8.3fs" % (name, duration))
+
+    return 0 if statuses and statuses[0].startswith("200") else 1
+
+
 def main(av):
+    time_main_start = time.perf_counter()
+
     cli_options = CliOptions(av[1:])
 
     logging_level = logging.WARN
@@ -888,6 +3081,10 @@ def main(av):
 
     logging.debug("Debug messages enabled")
 
+    if cli_options.profile_startup and (cli_options.workers > 0 or cli_options.export):
+        logging.critical("Profiling the startup is only supported when serving from a single process")
+        return 1
+
     path_data = pathlib.Path(cli_options.data_dir)
     if not path_data.is_dir():
         path_data = pathlib.Path(Defaults.DIR_SYS_DATA) / Defaults.PROGRAM_NAME
@@ -912,6 +3109,11 @@ def main(av):
                 return 1
 
     bottle.TEMPLATE_PATH = [path_ui / "templates"]
+    # NOTE: the compiled templates are kept across runs, mako only compiles them again when their source is more recent
+    # than the compiled module, which doesn't hold when switching interfaces or installing an older release of the
+    # templates, so they are kept apart according to the path and content of the templates
+    path_templates = path_cache / "templates" / templates_key(path_ui / "templates")
+    bottle.MakoTemplate.global_config("module_directory", str(path_templates))
     # FIXME: the resources will be unpacked in the cache, but they are generated from the ui directory first
     bottle.app().resources = bottle.ResourceManager(str(path_ui / "static") + os.sep)
     bottle.app().resources.add_path(".")
@@ -924,11 +3126,74 @@ def main(av):
         logging.critical("couldn't create the thumbnail directory: %s", e)
         return 1
 
-    bottle.install(MediaDatabasePlugin(cli_options.paths, path_thumbnails))
+    if cli_options.thumbnails_store:
+        path_store = pathlib.Path(cli_options.thumbnails_store)
+        if not path_store.is_dir():
+            logging.critical("No such thumbnail store: %s", path_store)
+            return 1
+
+        thumbnails = ThumbnailStore(path_store, sharded=True,
+                                    path_local=path_thumbnails if cli_options.local_thumbnails else None)
+    else:
+        thumbnails = ThumbnailStore(path_thumbnails)
+
+    if cli_options.export:
+        try:
+            mdb = MediaDatabase(cli_options.paths, thumbnails,
+                                generate_thumbnails=cli_options.generate_thumbnails, verify_duplicates=cli_options.verify_duplicates)
+            GalleryExporter(mdb, pathlib.Path(cli_options.export), path_ui, path_templates=path_templates).Run()
+        except (MediaDatabaseError, ExportError) as e:
+            logging.critical("%s", e)
+            return 1
+
+        return 0
+
+    if cli_options.workers > 0:
+        try:
+            sock = socket.create_server((cli_options.host, cli_options.port))
+        except OSError as e:
+            logging.critical("couldn't listen on %s:%d: %s", cli_options.host, cli_options.port, e)
+            return 1
+
+        logging.info("listening on http://%s:%d/ with %d workers", cli_options.host, cli_options.port, cli_options.workers)
+
+        with sock:
+            coordinator = PreforkCoordinator(cli_options.workers, sock, cli_options.paths,
+                                             path_cache / "index", thumbnails,
+                                             generate_thumbnails=cli_options.generate_thumbnails,
+                                             verify_duplicates=cli_options.verify_duplicates,
+                                             count_preview_jobs=cli_options.preview_jobs,
+                                             preview_budget=cli_options.preview_budget * 1024 * 1024,
+                                             debug=cli_options.debug)
+            return coordinator.Run()
+
+    metrics = Metrics()
+
+    bottle.install(MetricsPlugin(metrics))
+    bottle.install(CompressionPlugin(metrics))
+
+    time_scan_start = time.perf_counter()
+    mdb_plugin = MediaDatabasePlugin(cli_options.paths, thumbnails, metrics,
+                                     generate_thumbnails=cli_options.generate_thumbnails,
+                                     verify_duplicates=cli_options.verify_duplicates)
+    bottle.install(mdb_plugin)
+
+    previews = PreviewTranscoder(thumbnails, cli_options.preview_jobs, cli_options.preview_budget * 1024 * 1024, metrics)
+    bottle.install(PreviewPlugin(previews))
+
+    if cli_options.profile_startup:
+        return profile_startup(time_main_start, time_scan_start, time.perf_counter())
+
+    # NOTE: in debug mode, the parent process only watches the files and restarts the one that serves requests
+    if not cli_options.debug or os.getenv("BOTTLE_CHILD"):
+        previews.Start()
+        previews.SubmitAll(mdb_plugin.mdb.db.values())
 
     bottle.run(host=cli_options.host, port=cli_options.port,
                debug=cli_options.debug, reloader=cli_options.debug)
 
+    previews.Stop()
+
     return 0
 
 
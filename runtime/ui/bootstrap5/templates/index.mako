@@ -4,10 +4,10 @@
         <meta charset="utf-8">
         <meta name="viewport" content="width=device-width, initial-scale=1">
 
-        <link rel="stylesheet" href="/static/vendor/bootstrap/v5.1.0/css/bootstrap.min.css">
-        <link rel="stylesheet" href="/static/vendor/bootstrap-icons/v1.5.0/bootstrap-icons.min.css">
+        <link rel="stylesheet" href="${router.get_url("static", path="vendor/bootstrap/v5.1.0/css/bootstrap.min.css")}">
+        <link rel="stylesheet" href="${router.get_url("static", path="vendor/bootstrap-icons/v1.5.0/bootstrap-icons.min.css")}">
 
-        <link rel="icon" href="/static/image/tsunami.svg" sizes="any" type="image/svg+xml">
+        <link rel="icon" href="${router.get_url("static", path="image/tsunami.svg")}" sizes="any" type="image/svg+xml">
 
         <title>
             MediaSurf - ${page.all_entries_count} entries
@@ -23,7 +23,7 @@
     <body class="bg-light">
         <nav class="navbar sticky-top navbar-expand-lg navbar-dark bg-dark">
             <div class="container-fluid">
-                <a class="navbar-brand" href="/">
+                <a class="navbar-brand" href="${router.get_url("index")}">
                     <i class="bi bi-tsunami d-inline-block align-text-top"></i>
                     MediaSurf
                 </a>
@@ -342,11 +342,7 @@
                                             <select class="form-select" id="sortTagsName" required>
                                                 <option value="" selected>Pick a tag</option>
 
-                                                % for tag_name in page.tag_sort_keys:
-
-                                                <option value="${tag_name}">${tag_name}</option>
-
-                                                % endfor
+                                                ${fragment(("tag_options",), lambda: capture(tag_options))}
                                             </select>
 
                                             <select class="form-select" id="sortTagsCast">
@@ -447,11 +443,7 @@
                                             <select class="form-select" id="filterTagsName" required>
                                                 <option value="" selected>Pick a tag</option>
 
-                                                % for tag_name in page.tag_sort_keys:
-
-                                                <option value="${tag_name}">${tag_name}</option>
-
-                                                % endfor
+                                                ${fragment(("tag_options",), lambda: capture(tag_options))}
                                             </select>
 
                                             <input type="text" class="form-control" id="filterTagsValueInput" placeholder="e.g. Nokia" required>
@@ -492,7 +484,7 @@
                             </ul>
                         </li>
 
-                        <li class="nav-item text-light d-none d-lg-block">
+                        <li class="nav-item text-light d-none d-lg-block" data-pagination>
                             % if page.has_previous_page:
 
                             <a class="nav-link d-inline-block" href="${page.url_first_page}" title="Jump to the first page">
@@ -547,190 +539,15 @@
         <div class="container-fluid my-2">
             % if page.all_entries_count > 0:
 
-            <div class="row g-1 mb-3 mb-lg-0">
-                % for i, media in enumerate(page.entries):
-
-                % if media.resolution[0] < media.resolution[1]:
-
-                <div class="col-12 col-md-6 col-lg-4 col-xl-3 col-xxl-2">
-
-                % else:
-
-                <div class="col-12 col-md-12 col-lg-6 col-xl-4 col-xxl-3">
-
-                % endif
-
-                    <div class="card rounded-0 p-1 shadow-xs">
-                        <a href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}">
-                            % if media.type == "image":
-
-                            <picture class="mw-100">
-                                % if media.format.lower() == "gif":
-
-                                <img class="card-img-top rounded-0 border" src="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" loading="lazy">
-
-                                % else:
+            <div class="row g-1 mb-3 mb-lg-0" id="entries">
+                % for media in page.entries:
 
-                                <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="xxl", extension="webp")}" media="(min-width: 1400px)">
-                                <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="lg", extension="webp")}" media="(min-width: 992px)">
-                                <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="md", extension="webp")}" media="(min-width: 768px)">
-                                <img class="card-img-top rounded-0 border" src="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="sm", extension="webp")}" loading="lazy">
-
-                                % endif
-                            </picture>
-
-                            % elif media.type == "video":
-
-                            ## FIXME: find a way to load a breakpoint-specific poster with media-queries
-                            <video class="mw-100" controls muted preload="none" poster="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="xxl", extension="webp")}">
-                                <source src="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}">
-                            </video>
-
-                            % endif
-                        </a>
-
-                        <div class="card-img-overlay" style="bottom: inherit">
-                            <div class="d-flex justify-content-between">
-                                <ul class="list-inline">
-                                    % if media.type == "image":
-
-                                    <li class="list-inline-item">
-                                        <i class="bi bi-file-image text-light"></i>
-                                    </li>
-
-                                    % elif media.type == "video":
-
-                                    <li class="list-inline-item">
-                                        <i class="bi bi-file-play-fill text-light"></i>
-                                    </li>
-
-                                    % endif
-
-                                    <li class="list-inline-item">
-                                        <a class="text-decoration-none link-light" href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" download="${media.path.name}">
-                                            <i class="bi bi-save"></i>
-                                        </a>
-                                    </li>
-
-                                    <li class="list-inline-item">
-                                        <a class="text-decoration-none link-light" href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" target="_blank">
-                                            <i class="bi bi-box-arrow-up-right"></i>
-                                        </a>
-                                    </li>
-                                </ul>
-
-                                ## TODO: implement
-                                <ul class="list-inline">
-                                    <li class="list-inline-item">
-                                        <a class="text-decoration-none link-light" href="#">
-                                            <i class="bi bi-arrow-clockwise"></i>
-                                        </a>
-                                    </li>
-
-                                    <li class="list-inline-item">
-                                        <a class="text-decoration-none link-light" href="#">
-                                            <i class="bi bi-arrow-counterclockwise"></i>
-                                        </a>
-                                    </li>
-                                </ul>
-                            </div>
-                        </div>
-
-                        <table class="table table-striped table-sm table-responsive mb-0 mt-1">
-                            <tbody>
-                                <tr>
-                                    <th scope="row" class="h6 lh-base">
-                                        name
-                                    </th>
-
-                                    <td>
-                                        ${media.name}
-                                    </td>
-                                </tr>
-
-                                <tr>
-                                    <th scope="row" class="h6 lh-base">
-                                        date
-                                    </th>
-
-                                    <td>
-                                        ${media.filetime.strftime("%c")}
-                                    </td>
-                                </tr>
-                            </tbody>
-                        </table>
-
-                        <div class="accordion accordion-flush" id="accordionTags${i}">
-                            <div class="accordion-item">
-                                <div class="accordion-header" id="accordionTagsHeading${i}">
-                                    <button class="accordion-button collapsed p-1 text-muted" type="button" data-bs-toggle="collapse" data-bs-target="#accordionTagsCollapse${i}" aria-expanded="false" aria-controls="accordionTagsCollapse${i}">
-                                        <small>details</small>
-                                    </button>
-                                </div>
-
-                                <div id="accordionTagsCollapse${i}" class="accordion-collapse collapse" aria-labelledby="accordionTagsHeading${i}" data-bs-parent="#accordionTags${i}">
-                                    <div class="accordion-body p-0">
-                                        <table class="table table-striped table-sm table-responsive mb-0 mt-1">
-                                            <tbody>
-                                                <tr>
-                                                    <th scope="row" class="h6 lh-base">
-                                                        format
-                                                    </th>
-
-                                                    <td>
-                                                        <span class="badge bg-secondary">
-                                                            ${media.format}
-                                                        </span>
-                                                    </td>
-                                                </tr>
-                                            </tbody>
-                                        </table>
-
-                                        % if media.tags:
-
-                                        <table class="table table-striped table-sm table-responsive mb-0 mt-1">
-                                            <thead>
-                                                <tr>
-                                                    <th scope="col">
-                                                        tag
-                                                    </th>
-
-                                                    <th scope="col">
-                                                        value
-                                                    </th>
-                                                </tr>
-                                            </thead>
-
-                                            <tbody>
-                                                % for k, v in media.tags.items():
-
-                                                <tr>
-                                                    <th scope="row" class="h6 lh-base">
-                                                        ${k}
-                                                    </th>
-
-                                                    <td>
-                                                        ${v}
-                                                    </td>
-                                                </tr>
-
-                                                % endfor
-
-                                            </tbody>
-                                        </table>
-
-                                        % endif
-                                    </div>
-                                </div>
-                            </div>
-                        </div>
-                    </div>
-                </div>
+                ${fragment(("card", media.hash), lambda: capture(card, media))}
 
                 % endfor
             </div>
 
-            <nav class="d-lg-none">
+            <nav class="d-lg-none" data-pagination>
                 <ul class="pagination justify-content-end">
                     % if page.has_previous_page:
 
@@ -817,7 +634,7 @@
 
         ## TODO: footer
 
-        <script src="/static/vendor/bootstrap/v5.1.0/js/bootstrap.bundle.min.js"></script>
+        <script src="${router.get_url("static", path="vendor/bootstrap/v5.1.0/js/bootstrap.bundle.min.js")}"></script>
         <script>
             const searchFormInput = document.querySelector('#searchForm input[name="search"]'),
                   searchFormReset = document.getElementById("searchFormReset"),
@@ -904,5 +721,365 @@
                 return false;
             }
         </script>
+
+        % if static_export:
+
+        ## NOTE: there is no server to run queries in exported galleries, they are run by the browser on the index of all the entries
+        <script>
+            (function () {
+                const params = new URLSearchParams(window.location.search),
+                      query = params.get("search") || "",
+                      limit = Math.max(parseInt(params.get("limit")) || ${page.limit}, 10),
+                      page = Math.max(parseInt(params.get("page")) || 1, 1),
+                      entriesContainer = document.getElementById("entries");
+
+                if (!entriesContainer || !(params.has("search") || params.has("limit") || params.has("page"))) {
+                    return;
+                }
+
+                document.querySelector('#searchForm input[name="search"]').value = query;
+
+                function unquote(s) {
+                    return s.replace(/^(["'])(.*)\1$/, "$2");
+                }
+
+                function parseQuery(s) {
+                    const filters = new Map();
+                    let sort = null;
+
+                    for (const token of s.match(/(?:[^\s"']+|"[^"]*"|'[^']*')+/g) || []) {
+                        const i = token.indexOf(":");
+                        if (i < 0) {
+                            continue;
+                        }
+
+                        const command = token.slice(0, i),
+                              argument = token.slice(i + 1);
+
+                        if (command === "sort") {
+                            const parts = argument.split(":");
+                            if (parts[0] === "tag") {
+                                sort = {key: "tag", tag: parts[1], cast: parts[2] || "s", order: "desc"};
+                            } else {
+                                sort = {key: parts[0], cast: parts[1] || "s", order: "desc"};
+                            }
+                        } else if (command === "order") {
+                            if (sort) {
+                                sort.order = argument;
+                            }
+                        } else if (command === "tag") {
+                            const j = argument.indexOf(":");
+                            filters.set(command, j < 0 ? {name: argument} : {name: argument.slice(0, j), value: unquote(argument.slice(j + 1))});
+                        } else {
+                            filters.set(command, unquote(argument));
+                        }
+                    }
+
+                    return {filters: filters, sort: sort};
+                }
+
+                // NOTE: dates are compared as integers of the form YYYYMMDD, like on the server
+                function dateRange(s) {
+                    const m = /^(\d{4})(?:\/(\d{1,2})(?:\/(\d{1,2}))?)?$/.exec(s);
+                    if (!m) {
+                        return null;
+                    }
+
+                    const key = parseInt(m[1]) * 10000 + (m[2] ? parseInt(m[2]) * 100 : 0) + (m[3] ? parseInt(m[3]) : 0);
+                    return [key, m[3] ? key : (m[2] ? key + 99 : key + 9999)];
+                }
+
+                function castValue(value, cast) {
+                    if (cast === "n") {
+                        return /^\s*[+-]?\d+\s*$/.test(value) ? parseInt(value) : 0;
+                    } else if (cast === "d") {
+                        const m = /^(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})$/.exec(value);
+                        return m ? Date.UTC(m[1], m[2] - 1, m[3], m[4], m[5], m[6]) : 0;
+                    }
+                    return value;
+                }
+
+                function filterEntries(entries, filters) {
+                    for (const [command, argument] of filters) {
+                        if (command === "name") {
+                            entries = entries.filter(e => e.name.toLowerCase().includes(argument.toLowerCase()));
+                        } else if (command === "type") {
+                            entries = entries.filter(e => e.type === argument);
+                        } else if (command === "tag") {
+                            entries = entries.filter(e => "value" in argument ? (e.tags[argument.name] || "") === argument.value : argument.name in e.tags);
+                        } else if (command === "date" || command === "from" || command === "to") {
+                            const range = dateRange(argument);
+                            if (range === null) {
+                                entries = [];
+                            } else if (command === "date") {
+                                entries = entries.filter(e => range[0] <= e.date && e.date <= range[1]);
+                            } else if (command === "from") {
+                                entries = entries.filter(e => e.date >= range[0]);
+                            } else {
+                                entries = entries.filter(e => e.date <= range[1]);
+                            }
+                        }
+                    }
+                    return entries;
+                }
+
+                function sortEntries(entries, sort) {
+                    let key;
+                    if (sort.key === "name") {
+                        key = e => sort.cast === "d" ? (dateRange(e.name) || [0])[0] : castValue(e.name, sort.cast);
+                    } else if (sort.key === "date") {
+                        key = e => e.time;
+                    } else if (sort.key === "tag") {
+                        key = e => castValue(e.tags[sort.tag] || "", sort.cast);
+                    } else {
+                        return entries;
+                    }
+
+                    const keys = new Map(entries.map(e => [e, key(e)])),
+                          direction = sort.order === "asc" ? 1 : -1;
+                    return entries.slice().sort(function (a, b) {
+                        const ka = keys.get(a), kb = keys.get(b);
+                        return (ka < kb ? -1 : (ka > kb ? 1 : 0)) * direction;
+                    });
+                }
+
+                function pageLink(icon, number, enabled) {
+                    params.set("page", number);
+                    return '<li class="page-item' + (enabled ? '' : ' disabled') + '">'
+                           + '<a class="page-link" href="' + (enabled ? '?' + params.toString() : '#') + '"><i class="bi ' + icon + '"></i></a>'
+                           + '</li>';
+                }
+
+                fetch("index.json").then(response => response.json()).then(function (index) {
+                    const q = parseQuery(query);
+
+                    let entries = index.media.map(values => Object.fromEntries(index.fields.map((field, i) => [field, values[i]])));
+                    entries = filterEntries(entries, q.filters);
+                    if (q.sort) {
+                        entries = sortEntries(entries, q.sort);
+                    }
+
+                    const offset = (page - 1) * limit,
+                          entriesPage = entries.slice(offset, offset + limit);
+
+                    return Promise.all(entriesPage.map(e => fetch("cards/" + e.hash + ".html").then(response => response.text()))).then(function (cards) {
+                        document.title = "MediaSurf - " + entries.length + " entries";
+
+                        for (const e of document.querySelectorAll("[data-pagination]")) {
+                            e.remove();
+                        }
+
+                        entriesContainer.innerHTML = cards.length ? cards.join("") : '<div class="alert alert-light border">No entries! Try tweaking the search query.</div>';
+
+                        const nav = document.createElement("nav");
+                        nav.innerHTML = '<ul class="pagination justify-content-end mt-2">'
+                                        + pageLink("bi-chevron-compact-left", page - 1, page > 1)
+                                        + '<li class="page-item"><div class="page-link text-dark">'
+                                        + (entriesPage.length ? offset + 1 : 0) + ' — ' + (offset + entriesPage.length) + ' of ' + entries.length
+                                        + '</div></li>'
+                                        + pageLink("bi-chevron-compact-right", page + 1, offset + limit < entries.length)
+                                        + '</ul>';
+                        entriesContainer.after(nav);
+                    });
+                });
+            })();
+        </script>
+
+        % endif
     </body>
 </html>
+
+<%def name="tag_options()">
+    % for tag_name in page.tag_sort_keys:
+
+    <option value="${tag_name}">${tag_name}</option>
+
+    % endfor
+</%def>
+
+<%def name="card(media)">
+    % if media.resolution[0] < media.resolution[1]:
+
+    <div class="col-12 col-md-6 col-lg-4 col-xl-3 col-xxl-2">
+
+    % else:
+
+    <div class="col-12 col-md-12 col-lg-6 col-xl-4 col-xxl-3">
+
+    % endif
+
+        <div class="card rounded-0 p-1 shadow-xs">
+            <a href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}">
+                % if media.type == "image":
+
+                <picture class="mw-100">
+                    % if media.format.lower() == "gif":
+
+                    <img class="card-img-top rounded-0 border" src="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" loading="lazy">
+
+                    % else:
+
+                    <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="xxl", extension="webp")}" media="(min-width: 1400px)">
+                    <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="lg", extension="webp")}" media="(min-width: 992px)">
+                    <source srcset="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="md", extension="webp")}" media="(min-width: 768px)">
+                    <img class="card-img-top rounded-0 border" src="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="sm", extension="webp")}" loading="lazy">
+
+                    % endif
+                </picture>
+
+                % elif media.type == "video":
+
+                ## FIXME: find a way to load a breakpoint-specific poster with media-queries
+                <video class="mw-100" controls muted preload="none" poster="${router.get_url("media_uuid_thumbnail", uuid_media=media.hash, breakpoint="xxl", extension="webp")}">
+                    ## NOTE: without previews, the original is played directly rather than through a redirection
+                    % if static_export or not video_previews:
+                    <source src="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}">
+                    % else:
+                    <source src="${router.get_url("media_uuid_preview", uuid_media=media.hash, breakpoint="xxl", extension="mp4")}" type="video/mp4" media="(min-width: 1400px)">
+                    <source src="${router.get_url("media_uuid_preview", uuid_media=media.hash, breakpoint="lg", extension="mp4")}" type="video/mp4" media="(min-width: 992px)">
+                    <source src="${router.get_url("media_uuid_preview", uuid_media=media.hash, breakpoint="md", extension="mp4")}" type="video/mp4" media="(min-width: 768px)">
+                    <source src="${router.get_url("media_uuid_preview", uuid_media=media.hash, breakpoint="sm", extension="mp4")}" type="video/mp4">
+                    % endif
+                </video>
+
+                % endif
+            </a>
+
+            <div class="card-img-overlay" style="bottom: inherit">
+                <div class="d-flex justify-content-between">
+                    <ul class="list-inline">
+                        % if media.type == "image":
+
+                        <li class="list-inline-item">
+                            <i class="bi bi-file-image text-light"></i>
+                        </li>
+
+                        % elif media.type == "video":
+
+                        <li class="list-inline-item">
+                            <i class="bi bi-file-play-fill text-light"></i>
+                        </li>
+
+                        % endif
+
+                        <li class="list-inline-item">
+                            <a class="text-decoration-none link-light" href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" download="${media.path.name}">
+                                <i class="bi bi-save"></i>
+                            </a>
+                        </li>
+
+                        <li class="list-inline-item">
+                            <a class="text-decoration-none link-light" href="${router.get_url("media_uuid", uuid_media=media.hash, extension=media.extension or media.format)}" target="_blank">
+                                <i class="bi bi-box-arrow-up-right"></i>
+                            </a>
+                        </li>
+                    </ul>
+
+                    ## TODO: implement
+                    <ul class="list-inline">
+                        <li class="list-inline-item">
+                            <a class="text-decoration-none link-light" href="#">
+                                <i class="bi bi-arrow-clockwise"></i>
+                            </a>
+                        </li>
+
+                        <li class="list-inline-item">
+                            <a class="text-decoration-none link-light" href="#">
+                                <i class="bi bi-arrow-counterclockwise"></i>
+                            </a>
+                        </li>
+                    </ul>
+                </div>
+            </div>
+
+            <table class="table table-striped table-sm table-responsive mb-0 mt-1">
+                <tbody>
+                    <tr>
+                        <th scope="row" class="h6 lh-base">
+                            name
+                        </th>
+
+                        <td>
+                            ${media.name}
+                        </td>
+                    </tr>
+
+                    <tr>
+                        <th scope="row" class="h6 lh-base">
+                            date
+                        </th>
+
+                        <td>
+                            ${media.filetime.strftime("%c")}
+                        </td>
+                    </tr>
+                </tbody>
+            </table>
+
+            <div class="accordion accordion-flush" id="accordionTags${media.hash}">
+                <div class="accordion-item">
+                    <div class="accordion-header" id="accordionTagsHeading${media.hash}">
+                        <button class="accordion-button collapsed p-1 text-muted" type="button" data-bs-toggle="collapse" data-bs-target="#accordionTagsCollapse${media.hash}" aria-expanded="false" aria-controls="accordionTagsCollapse${media.hash}">
+                            <small>details</small>
+                        </button>
+                    </div>
+
+                    <div id="accordionTagsCollapse${media.hash}" class="accordion-collapse collapse" aria-labelledby="accordionTagsHeading${media.hash}" data-bs-parent="#accordionTags${media.hash}">
+                        <div class="accordion-body p-0">
+                            <table class="table table-striped table-sm table-responsive mb-0 mt-1">
+                                <tbody>
+                                    <tr>
+                                        <th scope="row" class="h6 lh-base">
+                                            format
+                                        </th>
+
+                                        <td>
+                                            <span class="badge bg-secondary">
+                                                ${media.format}
+                                            </span>
+                                        </td>
+                                    </tr>
+                                </tbody>
+                            </table>
+
+                            % if media.tags:
+
+                            <table class="table table-striped table-sm table-responsive mb-0 mt-1">
+                                <thead>
+                                    <tr>
+                                        <th scope="col">
+                                            tag
+                                        </th>
+
+                                        <th scope="col">
+                                            value
+                                        </th>
+                                    </tr>
+                                </thead>
+
+                                <tbody>
+                                    % for k, v in media.tags.items():
+
+                                    <tr>
+                                        <th scope="row" class="h6 lh-base">
+                                            ${k}
+                                        </th>
+
+                                        <td>
+                                            ${v}
+                                        </td>
+                                    </tr>
+
+                                    % endfor
+
+                                </tbody>
+                            </table>
+
+                            % endif
+                        </div>
+                    </div>
+                </div>
+            </div>
+        </div>
+    </div>
+</%def>